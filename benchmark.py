@@ -0,0 +1,456 @@
+"""
+Offline benchmark of the bot: runs the whole pipeline of telegram_bot.run_once
+against fake Influx, telegram and slack backends with a synthetic cohort, and
+reports the wall time, peak memory and number of calls per stage.
+
+    python benchmark.py --participants 100 --days 30 --output bench.jsonl
+    python benchmark.py --participants 100 --days 30 --baseline bench.jsonl
+"""
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import collections
+
+import numpy as np
+import pandas as pd
+import metrics
+import transport
+import telegram_bot as tb
+
+from studies import Study
+from msg_store import MsgStore
+from influxdb.resultset import ResultSet
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    """Stands in for the requests session of transport.py, counts the requests per endpoint"""
+
+    def __init__(self, cohort, latency=0):
+        self.cohort = cohort
+        self.latency = latency  # s per request
+        self.requests = collections.Counter()
+        self.incoming_msgs = []
+
+    def get(self, url, params=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.requests[endpoint] += 1
+        time.sleep(self.latency)
+        if endpoint == "getUpdates":
+            offset = params.get("offset") or 0
+            return FakeResponse(
+                {
+                    "ok": True,
+                    "result": [
+                        msg for msg in self.incoming_msgs if msg["update_id"] >= offset
+                    ],
+                }
+            )
+        return FakeResponse({"ok": True, "result": {"message_id": 1}})
+
+    def post(self, url, **kwargs):
+        self.requests["slack"] += 1
+        time.sleep(self.latency)
+        return FakeResponse({"ok": True})
+
+    def close(self):
+        pass
+
+    def send_commands(self, n, text="last vote"):
+        """The first n participants send a command to the bot"""
+        first_update = len(self.incoming_msgs) + 1
+        for i, chat_id in enumerate(self.cohort.chat_ids[:n]):
+            self.incoming_msgs.append(
+                {
+                    "update_id": first_update + i,
+                    "message": {
+                        "message_id": first_update + i,
+                        "from": {"id": chat_id},
+                        "text": text,
+                    },
+                }
+            )
+
+
+class FakeInflux:
+    """
+    Stands in for the InfluxDBClient, answers the queries of UserProgress from
+    the synthetic cohort and counts them and the bytes of their results
+    """
+
+    def __init__(self, cohort, latency=0):
+        self.cohort = cohort
+        self.latency = latency  # s per query
+        self.queries = 0
+        self.bytes = 0
+        # the defaults of InfluxDBClient
+        self._headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/x-msgpack",
+        }
+
+    def query(self, query, **kwargs):
+        self.queries += 1
+        time.sleep(self.latency)
+        results = [
+            {"statement_id": i, "series": self.statement_series(statement)}
+            for i, statement in enumerate(query.split(";"))
+        ]
+        self.bytes += len(json.dumps({"results": results}))
+        results = [ResultSet(result) for result in results]
+        return results[0] if len(results) == 1 else results
+
+    def statement_series(self, query):
+        match = re.search(r"userid =~ /\^\((.*?)\)\$/", query, re.IGNORECASE)
+        if match:
+            participant_ids = match.group(1).split("|")
+        else:
+            participant_ids = re.findall(
+                r"userid\s*=\s*'([^']*)'", query, re.IGNORECASE
+            )
+        # the bounds of the time conditions, the time < now() ones are ignored
+        bounds = {
+            operator: pd.Timestamp(literal).value
+            for operator, literal in re.findall(r"time ([<>]=?) '([^']+)'", query)
+        }
+
+        series = []
+        for participant_id in participant_ids:
+            if participant_id not in self.cohort.votes:
+                continue
+            if "Steerpath" in query:
+                times, values = self.cohort.locations[participant_id]
+                tag, columns = "Userid", ["Longitude", "Latitude", "Space_id"]
+            else:
+                times, values = self.cohort.votes[participant_id]
+                tag, columns = "userid", ["thermal"]
+            start, end = 0, len(times)
+            if ">" in bounds:
+                start = np.searchsorted(times, bounds[">"], side="right")
+            if ">=" in bounds:
+                start = np.searchsorted(times, bounds[">="], side="left")
+            if "<=" in bounds:
+                end = np.searchsorted(times, bounds["<="], side="right")
+            if "last(" in query:
+                start, columns = max(start, end - 1), ["last"]
+            if start >= end:
+                continue
+            time_strs = np.datetime_as_string(
+                times[start:end].astype("datetime64[ns]"), unit="s"
+            )
+            series.append(
+                {
+                    "name": "Steerpath" if tag == "Userid" else "cozie",
+                    "tags": {tag: participant_id},
+                    "columns": ["time"] + columns,
+                    "values": [
+                        [f"{time_str}Z", *row]
+                        for time_str, *row in zip(
+                            time_strs,
+                            *(column[start:end].tolist() for column in values),
+                        )
+                    ],
+                }
+            )
+        return series
+
+    def request(
+        self,
+        url,
+        method,
+        params,
+        stream=False,
+        expected_response_code=200,
+        headers=None,
+    ):
+        """Chunked response of a query, see UserProgress.stream_points"""
+        headers = self._headers if headers is None else headers
+        if headers.get("Accept") != "application/json":
+            # the real client would get msgpack, not JSON lines
+            raise ValueError(f"Chunked query without JSON Accept header: {headers}")
+        self.queries += 1
+        time.sleep(self.latency)
+        chunk_size = int(params["chunk_size"])
+        lines = []
+        for series in self.statement_series(params["q"]):
+            values = [
+                [pd.Timestamp(row[0]).value, *row[1:]] for row in series["values"]
+            ]
+            for start in range(0, len(values), chunk_size):
+                chunk = dict(series, values=values[start : start + chunk_size])
+                result = {"statement_id": 0, "series": [chunk], "partial": True}
+                lines.append(json.dumps({"results": [result]}).encode())
+        self.bytes += sum(len(line) for line in lines)
+        return FakeStream(lines)
+
+    def close(self):
+        pass
+
+
+class FakeStream:
+    """Streamed response of FakeInflux.request"""
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+    def close(self):
+        pass
+
+
+class SyntheticCohort:
+    """Votes and Steerpath locations of n participants over the last days"""
+
+    def __init__(self, n, days, votes_per_day, locations_per_hour, n_spaces=20, seed=0):
+        rng = np.random.default_rng(seed)
+        end = pd.Timestamp.now("UTC").value
+        start = end - days * 24 * 3600 * 10**9
+        self.participant_ids = [f"p{i:05d}" for i in range(n)]
+        self.chat_ids = [100000 + i for i in range(n)]
+        self.space_names = {-1: "outdoor"}
+        self.space_names.update({i: f"space {i}" for i in range(1, n_spaces + 1)})
+        self.votes = {}
+        self.locations = {}
+        for participant_id in self.participant_ids:
+            n_votes = rng.poisson(votes_per_day * days)
+            vote_times = np.unique(
+                rng.integers(start, end, n_votes) // 10**9 * 10**9
+            )
+            # times in ns and the columns of the points
+            self.votes[participant_id] = (
+                vote_times,
+                [rng.integers(9, 12, len(vote_times))],
+            )
+            n_locations = rng.poisson(locations_per_hour * days * 24)
+            location_times = np.unique(
+                rng.integers(start, end, n_locations) // 10**9 * 10**9
+            )
+            self.locations[participant_id] = (
+                location_times,
+                [
+                    rng.uniform(103.77, 103.78, len(location_times)),
+                    rng.uniform(1.29, 1.30, len(location_times)),
+                    rng.choice(list(self.space_names), len(location_times)),
+                ],
+            )
+
+    def write_participants(self, location):
+        with open(location, "w") as f:
+            f.write("chat_id,user\n")
+            for chat_id, participant_id in zip(self.chat_ids, self.participant_ids):
+                f.write(f"{chat_id},{participant_id}\n")
+
+
+def run_scenario(name, study, msg_store, session, influx_cl, logger, args):
+    """Run the pipeline once with fresh module state, returns its measures"""
+    tb.close_user_progress()
+    tb._influx_cl = influx_cl
+    transport._session = session
+    session.requests.clear()
+    influx_cl.queries = 0
+    influx_cl.bytes = 0
+
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    tb.run_once(
+        study,
+        msg_store,
+        logger,
+        logger,
+        max_concurrency=args.concurrency,
+        max_workers=args.workers,
+    )
+    wall_seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1] if args.memory else None
+    tracemalloc.stop()
+
+    run_metrics = metrics.current
+    stages = {
+        stage: {
+            "calls": n,
+            "seconds": round(seconds, 6),
+            "peak_memory_mb": round(run_metrics.peak_memory[stage] / 2**20, 3)
+            if stage in run_metrics.peak_memory
+            else None,
+        }
+        for stage, (n, seconds) in sorted(run_metrics.stage_totals().items())
+    }
+    return {
+        "scenario": name,
+        "config": {
+            key: getattr(args, key)
+            for key in (
+                "participants",
+                "days",
+                "votes_per_day",
+                "locations_per_hour",
+                "workers",
+                "concurrency",
+                "memory",
+            )
+        },
+        "wall_seconds": round(wall_seconds, 6),
+        "peak_memory_mb": round(peak_memory / 2**20, 3) if args.memory else None,
+        "stages": stages,
+        "requests": dict(session.requests),
+        "influx_queries": influx_cl.queries,
+        "influx_bytes": influx_cl.bytes,
+    }
+
+
+def print_result(result, baseline=None):
+    """Table of the stages of a scenario, with the change from the baseline if given"""
+    baseline_stages = baseline["stages"] if baseline else {}
+    print(
+        f"\n=== {result['scenario']}: {result['wall_seconds']:.3f}s, "
+        f"peak memory {result['peak_memory_mb']} MB, "
+        f"{result['influx_queries']} Influx queries ({result['influx_bytes'] / 2**20:.2f} MB), "
+        f"requests {result['requests']}"
+    )
+    if baseline:
+        print(
+            f"    baseline: {baseline['wall_seconds']:.3f}s ({change(result['wall_seconds'], baseline['wall_seconds'])}), "
+            f"peak memory {baseline['peak_memory_mb']} MB"
+        )
+    print(f"{'stage':<18}{'calls':>8}{'seconds':>12}{'peak MB':>10}{'vs baseline':>14}")
+    for stage, measures in result["stages"].items():
+        baseline_seconds = baseline_stages.get(stage, {}).get("seconds")
+        print(
+            f"{stage:<18}{measures['calls']:>8}{measures['seconds']:>12.4f}"
+            f"{str(measures['peak_memory_mb']):>10}"
+            f"{change(measures['seconds'], baseline_seconds):>14}"
+        )
+
+
+def change(value, baseline):
+    if not baseline:
+        return "-"
+    return f"{(value - baseline) / baseline:+.0%}"
+
+
+def load_baseline(location):
+    """Last result of each scenario in a file written with --output"""
+    baseline = {}
+    with open(location) as f:
+        for line in f:
+            result = json.loads(line)
+            baseline[result["scenario"]] = result
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bot")
+    parser.add_argument("--participants", type=int, default=50)
+    parser.add_argument(
+        "--days", type=int, default=14, help="history of each participant"
+    )
+    parser.add_argument("--votes-per-day", type=float, default=20)
+    parser.add_argument(
+        "--locations-per-hour", type=float, default=12, help="Steerpath density"
+    )
+    parser.add_argument(
+        "--commands", type=int, default=5, help="participants that send a command"
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--influx-latency", type=float, default=0, help="s per query")
+    parser.add_argument("--http-latency", type=float, default=0, help="s per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="do not trace the memory, tracemalloc slows the run down",
+    )
+    parser.add_argument("--output", help="append the results to this JSON lines file")
+    parser.add_argument(
+        "--baseline", help="compare with the results saved with --output"
+    )
+    args = parser.parse_args()
+
+    cohort = SyntheticCohort(
+        args.participants,
+        args.days,
+        args.votes_per_day,
+        args.locations_per_hour,
+        seed=args.seed,
+    )
+    session = FakeSession(cohort, args.http_latency)
+    influx_cl = FakeInflux(cohort, args.influx_latency)
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    logger = logging.getLogger("benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    directory = tempfile.mkdtemp(prefix="cozie_bench_")
+    try:
+        cohort.write_participants(f"{directory}/chat_ids.csv")
+        study = Study(
+            "benchmark",
+            directory,
+            experiment_name="Benchmark",
+            token="benchmark",
+            database="benchmark",
+            measurement="cozie",
+            slack_webhook_url="https://hooks.slack.com/benchmark",
+        )
+        study.space_names = cohort.space_names
+
+        results = []
+        # daily report computed from the whole history
+        msg_store = MsgStore(f"{directory}/cold.db")
+        session.send_commands(args.commands)
+        results.append(
+            run_scenario(
+                "cold_report", study, msg_store, session, influx_cl, logger, args
+            )
+        )
+        msg_store.close()
+
+        # daily report of the next day, from the incremental state
+        msg_store = MsgStore(f"{directory}/incremental.db")
+        results.append(
+            run_scenario(
+                "incremental_report", study, msg_store, session, influx_cl, logger, args
+            )
+        )
+
+        # frequent run after the report was sent, only answers the commands
+        session.send_commands(args.commands, text="help")
+        results.append(
+            run_scenario("commands", study, msg_store, session, influx_cl, logger, args)
+        )
+        msg_store.close()
+    finally:
+        tb.close_user_progress()
+        shutil.rmtree(directory)
+
+    for result in results:
+        print_result(result, baseline.get(result["scenario"]))
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
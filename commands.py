@@ -0,0 +1,79 @@
+import functools
+
+
+class CommandRouter:
+    """
+    Commands that the participants can send to the bot, registered once with
+    their description and handler. A handler gets the study, the participant
+    and last_vote, a function returning the timestamp of the last vote, so
+    Influx is only queried by the commands that need it
+    """
+
+    def __init__(self):
+        self.commands = {}  # command -> (description, handler), in registration order
+
+    def command(self, name, description):
+        """Decorator registering the handler of a command"""
+
+        def register(handler):
+            self.commands[name] = (description, handler)
+            return handler
+
+        return register
+
+    def reply(self, text, study, participant_id, last_vote):
+        """The reply to a message, in a single telegram message"""
+        command = self.commands.get(text)
+        if command is None:
+            # if the user asked something that the bot does not know, send him list of available quesitons
+            return "\n".join(
+                ["The bot cannot answer this request. List of available requests:"]
+                + self.descriptions()
+            )
+        _, handler = command
+        return f"You have asked the bot for {text}:\n{handler(study, participant_id, last_vote)}"
+
+    def descriptions(self):
+        return [
+            f"{name}: {description}" for name, (description, _) in self.commands.items()
+        ]
+
+
+router = CommandRouter()
+
+
+@router.command("help", "Returns list of available requests")
+def help_command(study, participant_id, last_vote):
+    return f'List of available requests: {", ".join(router.commands)}'
+
+
+@router.command("last vote", "Returns the date and time of the last fitbit response")
+def last_vote_command(study, participant_id, last_vote):
+    vote_timestamp = last_vote()
+    return (
+        vote_timestamp.strftime("%b-%d %H:%M")
+        if vote_timestamp is not None
+        else "Error"
+    )
+
+
+@router.command("/start", "Message when the user initiate a conversation with the Bot")
+def start_command(study, participant_id, last_vote):
+    return welcome_msg(study.experiment_name)
+
+
+@functools.lru_cache(maxsize=None)
+def welcome_msg(experiment_name):
+    return (
+        f"Welcome to the {experiment_name} experiment. This telegram bot "
+        + "will be used to automatically send you messages about your progress "
+        + "during the experiment. In addition you can chat with the bot and "
+        + "ask a predefined set of questions.\n\n"
+        + 'Type and send "help" if you want to know the list of available '
+        + "commands you can ask bo the Bot\n\n"
+        + "Please remember that the Bot won't be able to answer any other "
+        + "request. Hence, please contact the research team via the designated "
+        + "telegram group. There might be a delay of a few minutes between "
+        + "the time you type and send a request and the time you receive and answer. "
+        + f"Thank you once again for participating in the {experiment_name} experiment."
+    )
@@ -0,0 +1,40 @@
+import os
+import shutil
+
+compression = "zstd"
+
+
+def export_votes(location, participant_id, localised_user_df):
+    """
+    Save the localised votes of a participant as compressed Parquet files,
+    partitioned by participant and date:
+    location/participant=<id>/date=<YYYY-MM-DD>/part-<first vote in ns>.parquet
+    Each run only exports the votes that became final since the previous one
+    (see UserProgress.daily_report), a file written again by a retried run is
+    overwritten. Needs pyarrow
+    """
+    if localised_user_df.empty:
+        return
+
+    for date, df_date in localised_user_df.groupby(localised_user_df.index.date):
+        partition = os.path.join(
+            participant_location(location, participant_id), f"date={date.isoformat()}"
+        )
+        os.makedirs(partition, exist_ok=True)
+        df_date.to_parquet(
+            os.path.join(partition, f"part-{df_date.index[0].value}.parquet"),
+            compression=compression,
+        )
+
+
+def clear_export(location, participant_id):
+    """
+    Delete the exported votes of a participant before they are all exported
+    again (e.g. after --rebuild), the files of the new run are split at other
+    votes and would not overwrite the previous ones
+    """
+    shutil.rmtree(participant_location(location, participant_id), ignore_errors=True)
+
+
+def participant_location(location, participant_id):
+    return os.path.join(location, f"participant={participant_id}")
@@ -0,0 +1,82 @@
+import time
+import sqlite3
+import threading
+import collections
+
+
+class InfluxCache:
+    """
+    Cache in front of the Influx queries of a study. The query results are kept
+    in memory for ttl seconds, the least recently used ones are evicted first.
+    The time of the last vote of each participant is also kept in SQLite, so
+    later runs only query the votes after it (see UserProgress.last_votes)
+    """
+
+    def __init__(self, location=None, ttl=60, max_entries=128):
+        """Without location the last votes are only kept in memory"""
+        self.ttl = ttl  # s
+        self.max_entries = max_entries
+        self.results = collections.OrderedDict()
+        # the daemon uses the cache from worker threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(location or ":memory:", check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS last_vote "
+                "(participant_id TEXT PRIMARY KEY, time TEXT, checked_at REAL NOT NULL)"
+            )
+
+    def get(self, query):
+        """Result of the query if it was cached less than ttl seconds ago, else None"""
+        with self.lock:
+            if query not in self.results:
+                return None
+            cached_at, result = self.results[query]
+            if time.time() - cached_at >= self.ttl:
+                del self.results[query]
+                return None
+            self.results.move_to_end(query)
+            return result
+
+    def put(self, query, result):
+        with self.lock:
+            self.results[query] = (time.time(), result)
+            self.results.move_to_end(query)
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+
+    def last_votes(self, participant_ids):
+        """
+        Cached time (ISO format, None if there were no votes) of the last vote and
+        time of the check, for the given participants that are in the cache
+        """
+        participant_ids = [str(participant_id) for participant_id in participant_ids]
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT participant_id, time, checked_at FROM last_vote "
+                f"WHERE participant_id IN ({','.join('?' * len(participant_ids))})",
+                participant_ids,
+            ).fetchall()
+        return {
+            participant_id: (last_vote_time, checked_at)
+            for participant_id, last_vote_time, checked_at in rows
+        }
+
+    def set_last_votes(self, last_vote_times):
+        """Save the time of the last vote (ISO format or None) of each participant"""
+        checked_at = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO last_vote (participant_id, time, checked_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(participant_id) DO UPDATE "
+                "SET time = excluded.time, checked_at = excluded.checked_at",
+                [
+                    (str(participant_id), last_vote_time, checked_at)
+                    for participant_id, last_vote_time in last_vote_times.items()
+                ],
+            )
+
+    def close(self):
+        with self.lock:
+            self.results.clear()
+            self.conn.close()
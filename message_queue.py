@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import threading
+import functools
+import collections
+
+import metrics
+
+from transport import run_bounded
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+telegram_global_rate = 30  # messages per second
+telegram_chat_rate = 1  # messages per second to the same chat
+
+
+class TokenBucket:
+    """Allows rate events per second on average, with bursts of up to capacity events"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class MessageBuffer:
+    """
+    Messages of a single participant, moved to the OutboundQueue only once the
+    analysis of the participant succeeded (see OutboundQueue.extend)
+    """
+
+    def __init__(self):
+        self.msgs = []
+
+    def put(self, msg, chat_id):
+        self.msgs.append((msg, chat_id))
+
+
+class OutboundQueue:
+    """
+    Queue of telegram messages between the report logic and the telegram API.
+    The messages are sent as fast as the telegram limits allow, messages
+    rejected with 429 are retried after the retry_after given by telegram and
+    the messages that could not be delivered are kept in a file for the next run.
+    The deliveries are appended to a log next to the file while flushing, the
+    file is only rewritten once at the end (see save)
+    """
+
+    def __init__(
+        self,
+        location,
+        send,
+        logger,
+        global_rate=telegram_global_rate,
+        chat_rate=telegram_chat_rate,
+        max_attempts=5,
+    ):
+        """send(msg, chat_id) sends one message and returns the telegram response"""
+        self.location = location
+        self.delivered_location = f"{location}.delivered"
+        self.send = send
+        self.logger = logger
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        # a 429 without chat specific limits pauses every chat
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+        # undelivered messages of previous runs go first
+        try:
+            self.pending = json.load(open(location))
+        except FileNotFoundError:
+            self.pending = []
+        # a run that died while flushing left the positions of the messages it delivered
+        try:
+            with open(self.delivered_location) as f:
+                delivered = {int(line) for line in f if line.strip()}
+        except FileNotFoundError:
+            delivered = None
+        if delivered is not None:
+            self.pending = [
+                msg for i, msg in enumerate(self.pending) if i not in delivered
+            ]
+            self.save()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, msg, chat_id):
+        self.pending.append({"chat_id": int(chat_id), "text": msg})
+
+    def extend(self, buffer):
+        """Queue the messages of a MessageBuffer, in order"""
+        for msg, chat_id in buffer.msgs:
+            self.put(msg, chat_id)
+
+    def save(self):
+        """
+        Write the pending messages atomically. The delivered log refers to the
+        previous file, it is removed first: if the process dies in between the
+        delivered messages are sent again rather than others being lost
+        """
+        tmp_location = f"{self.location}.tmp"
+        with open(tmp_location, "w") as f:
+            json.dump(self.pending, f)
+        if os.path.exists(self.delivered_location):
+            os.remove(self.delivered_location)
+        os.replace(tmp_location, self.location)
+
+    def flush(self, max_concurrency=1):
+        """
+        Deliver the pending messages to up to max_concurrency chats at once.
+        The messages to the same chat are sent one after the other to keep their order.
+        Each message is logged as soon as it is delivered, if the process dies
+        only the messages being sent at that moment can be sent again
+        """
+        if not self.pending:
+            return
+        # keep the messages on disk in case the process dies while sending them
+        self.save()
+        # position in the file of each message, see done
+        self.positions = {id(msg): i for i, msg in enumerate(self.pending)}
+        self.delivered = set()
+
+        msgs_by_chat = collections.defaultdict(list)
+        for msg in self.pending:
+            msgs_by_chat[msg["chat_id"]].append(msg)
+
+        with open(self.delivered_location, "a") as self.delivered_log:
+            results = run_bounded(
+                [
+                    functools.partial(self.deliver_chat, msgs)
+                    for msgs in msgs_by_chat.values()
+                ],
+                max_concurrency,
+            )
+        self.pending = [
+            msg for i, msg in enumerate(self.pending) if i not in self.delivered
+        ]
+
+        # the undelivered messages are still pending, in their order
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error(f"Error while sending telegram messages: {result}")
+        if self.pending:
+            self.logger.error(
+                f"{len(self.pending)} telegram messages could not be delivered, retrying in the next run"
+            )
+        self.save()
+
+    def done(self, msg):
+        """
+        Record a delivered (or dropped) message in the delivered log, it leaves
+        the pending ones at the end of flush
+        """
+        i = self.positions[id(msg)]
+        with self.lock:
+            self.delivered.add(i)
+            self.delivered_log.write(f"{i}\n")
+            self.delivered_log.flush()
+
+    def wait_for_pause(self):
+        with self.lock:
+            wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def deliver_chat(self, msgs):
+        """Send the messages of one chat in order, returns the undelivered ones"""
+        chat_bucket = TokenBucket(self.chat_rate)
+        for i, msg in enumerate(msgs):
+            for attempt in range(1, self.max_attempts + 1):
+                self.wait_for_pause()
+                chat_bucket.acquire()
+                self.global_bucket.acquire()
+                try:
+                    response = self.send(msg["text"], msg["chat_id"])
+                except Exception as e:
+                    # network error, keep the rest of the chat for the next run
+                    self.logger.error(
+                        f"Telegram message to {msg['chat_id']} failed with error: {e}"
+                    )
+                    return msgs[i:]
+
+                if response.get("ok", False):
+                    self.done(msg)
+                    break
+                if response.get("error_code") == 429:
+                    metrics.count("telegram_429")
+                    retry_after = response.get("parameters", {}).get("retry_after", 1)
+                    self.logger.info(
+                        f"Telegram rate limit hit, retrying after {retry_after}s"
+                    )
+                    with self.lock:
+                        self.paused_until = max(
+                            self.paused_until, time.monotonic() + retry_after
+                        )
+                    continue
+                # retrying other errors (e.g. chat not found) will fail again
+                self.logger.error(
+                    f"Telegram message to {msg['chat_id']} dropped: {response.get('description')}"
+                )
+                self.done(msg)
+                break
+            else:
+                # still rate limited, keep the rest of the chat for the next run
+                return msgs[i:]
+
+        return []
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+import collections
+
+from contextlib import contextmanager
+
+jsonl_max_bytes = 10 * 1024 * 1024  # size of the JSON lines file before it is rotated
+jsonl_backups = 5  # rotated files kept, metrics.jsonl.1 being the most recent
+
+
+class RunMetrics:
+    """
+    Timings and counters of one run of the bot, tagged by stage and participant
+    (None when the stage is not specific to a participant)
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.timings = collections.defaultdict(lambda: [0, 0.0, 0.0])  # n, sum, max
+        self.counters = collections.Counter()
+        self.peak_memory = {}  # bytes per stage, only if tracemalloc is tracing
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def timer(self, stage, participant=None):
+        """
+        Measure the wall time of the block, also when it raises. If tracemalloc
+        is tracing (see benchmark.py) the peak memory during the block is kept too
+        """
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            self.enter_memory_stage()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = self.exit_memory_stage() if tracing else None
+            with self.lock:
+                timing = self.timings[(stage, participant)]
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+                if peak is not None:
+                    self.peak_memory[stage] = max(self.peak_memory.get(stage, 0), peak)
+
+    def enter_memory_stage(self):
+        """
+        tracemalloc has a single peak, it is reset for each stage and the peaks
+        seen so far are carried to the enclosing stages of the same thread.
+        With several threads the peaks include the memory of the other threads
+        """
+        stack = self.local.__dict__.setdefault("memory_stack", [])
+        if stack:
+            stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+        stack.append(0)
+        tracemalloc.reset_peak()
+
+    def exit_memory_stage(self):
+        stack = self.local.memory_stack
+        peak = max(stack.pop(), tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1] = max(stack[-1], peak)
+        return peak
+
+    def count(self, name, value=1, participant=None):
+        with self.lock:
+            self.counters[(name, participant)] += value
+
+    def stage_totals(self):
+        """Number of calls and seconds per stage, summed over the participants"""
+        totals = collections.defaultdict(lambda: [0, 0.0])
+        for (stage, _), (n, seconds, _) in self.timings.items():
+            totals[stage][0] += n
+            totals[stage][1] += seconds
+        return totals
+
+    def records(self):
+        run_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.start))
+        for (stage, participant), (n, seconds, max_seconds) in self.timings.items():
+            yield {
+                "run": run_time,
+                "stage": stage,
+                "participant": participant,
+                "calls": n,
+                "seconds": round(seconds, 6),
+                "max_seconds": round(max_seconds, 6),
+            }
+        for (name, participant), value in self.counters.items():
+            yield {
+                "run": run_time,
+                "counter": name,
+                "participant": participant,
+                "value": value,
+            }
+
+    def write_jsonl(self, location):
+        """
+        Append the metrics of the run to a JSON lines file, one line per stage
+        and participant. The file is rotated between runs, see rotate_file
+        """
+        rotate_file(location)
+        with self.lock, open(location, "a") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+
+    def write_prometheus(self, location):
+        """Write the metrics of the run for the textfile collector of the Prometheus node exporter"""
+        lines = [
+            "# TYPE cozie_bot_stage_seconds summary",
+            "# TYPE cozie_bot_stage_max_seconds gauge",
+            "# TYPE cozie_bot_counter gauge",
+            "# TYPE cozie_bot_last_run_timestamp_seconds gauge",
+            f"cozie_bot_last_run_timestamp_seconds {self.start:.0f}",
+        ]
+        with self.lock:
+            for (stage, participant), (n, seconds, max_seconds) in self.timings.items():
+                labels = prometheus_labels(stage=stage, participant=participant)
+                lines.append(f"cozie_bot_stage_seconds_count{labels} {n}")
+                lines.append(f"cozie_bot_stage_seconds_sum{labels} {seconds:.6f}")
+                lines.append(f"cozie_bot_stage_max_seconds{labels} {max_seconds:.6f}")
+            for (name, participant), value in self.counters.items():
+                labels = prometheus_labels(name=name, participant=participant)
+                lines.append(f"cozie_bot_counter{labels} {value}")
+
+        # the collector must never read a half written file
+        tmp_location = f"{location}.tmp"
+        with open(tmp_location, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_location, location)
+
+    def digest(self):
+        """One line summary of the run, e.g. for slack"""
+        parts = [f"run {time.time() - self.start:.1f}s"]
+        for stage, (n, seconds) in sorted(self.stage_totals().items()):
+            parts.append(f"{stage} {seconds:.1f}s/{n}")
+        counters = collections.Counter()
+        for (name, _), value in self.counters.items():
+            counters[name] += value
+        parts.extend(f"{name} {value}" for name, value in sorted(counters.items()))
+        return " | ".join(parts)
+
+
+def rotate_file(location, max_bytes=jsonl_max_bytes, backups=jsonl_backups):
+    """
+    Once the file is larger than max_bytes, rename it to location.1 and the
+    previous location.1 to location.2 etc, the oldest beyond backups is deleted
+    (as logging.handlers.RotatingFileHandler does)
+    """
+    if not os.path.exists(location) or os.path.getsize(location) < max_bytes:
+        return
+    for i in range(backups - 1, 0, -1):
+        if os.path.exists(f"{location}.{i}"):
+            os.replace(f"{location}.{i}", f"{location}.{i + 1}")
+    if backups > 0:
+        os.replace(location, f"{location}.1")
+    else:
+        os.remove(location)
+
+
+def prometheus_labels(**labels):
+    """Format the labels that are not None, escaped as the text format requires"""
+    escaped = [
+        f'{key}="{escape_label_value(value)}"'
+        for key, value in labels.items()
+        if value is not None
+    ]
+    return "{" + ",".join(escaped) + "}" if escaped else ""
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# metrics of the current run, see reset
+current = RunMetrics()
+
+
+def reset():
+    """Start collecting the metrics of a new run"""
+    global current
+    current = RunMetrics()
+    return current
+
+
+def timer(stage, participant=None):
+    return current.timer(stage, participant)
+
+
+def count(name, value=1, participant=None):
+    current.count(name, value, participant)
@@ -0,0 +1,159 @@
+import os
+import json
+import sqlite3
+import threading
+
+
+class MsgStore:
+    """
+    Keeps track of the incoming telegram messages already handled, per chat,
+    of the getUpdates offset, of the updates to handle again and of the daily
+    reports already sent (ledger).
+    Backed by SQLite in WAL mode, the changes are written in one transaction
+    when commit is called
+    """
+
+    def __init__(self, location, json_location=None):
+        """json_location is the logs_msg.json file of older versions, migrated once"""
+        self.location = location
+        # the daemon uses the store from worker threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(location, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS incoming_msg "
+                "(chat_id INTEGER PRIMARY KEY, last_msg_id INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS bot_state "
+                "(key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS report_ledger "
+                "(report_date TEXT NOT NULL, participant_id TEXT NOT NULL, "
+                "sent_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                "PRIMARY KEY (report_date, participant_id))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS retry_update "
+                "(update_id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, "
+                "attempts INTEGER NOT NULL, update_json TEXT NOT NULL)"
+            )
+
+        if json_location is not None and os.path.isfile(json_location):
+            self.migrate_json(json_location)
+
+    def migrate_json(self, json_location):
+        """Import the message logs of logs_msg.json and rename the file"""
+        log_msg = json.load(open(json_location))
+        with self.lock, self.conn:
+            for key, value in log_msg.items():
+                if key == "getUpdates":
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO bot_state VALUES ('update_offset', ?)",
+                        (value["offset"],),
+                    )
+                else:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO incoming_msg VALUES (?, ?)",
+                        (int(key), value["incoming_msg"]["telegram_chat"]),
+                    )
+        os.replace(json_location, f"{json_location}.migrated")
+
+    def last_handled_msg_id(self, chat_id):
+        """Id of the last incoming message processed for chat_id, None if unknown"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT last_msg_id FROM incoming_msg WHERE chat_id = ?",
+                (int(chat_id),),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_last_handled_msg_id(self, chat_id, msg_id):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO incoming_msg VALUES (?, ?)",
+                (int(chat_id), msg_id),
+            )
+
+    def update_offset(self):
+        """Offset of the first telegram update that has not been acknowledged yet"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM bot_state WHERE key = 'update_offset'"
+            ).fetchone()
+        return row[0] if row is not None else 0
+
+    def set_update_offset(self, offset):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO bot_state VALUES ('update_offset', ?)",
+                (offset,),
+            )
+
+    def retry_updates(self):
+        """Telegram updates acknowledged but not handled yet, see set_retry_updates"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT update_json FROM retry_update ORDER BY update_id"
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def set_retry_updates(self, updates, failed_chats, max_attempts):
+        """
+        Keep the updates of the chats that could not be handled for the next
+        run, each is tried up to max_attempts times. The updates of the other
+        chats are done. Returns the updates given up
+        """
+        given_up = []
+        with self.lock:
+            attempts = dict(
+                self.conn.execute("SELECT update_id, attempts FROM retry_update")
+            )
+            self.conn.execute("DELETE FROM retry_update")
+            for update in updates:
+                if "message" not in update:
+                    continue
+                chat_id = update["message"]["from"]["id"]
+                if chat_id not in failed_chats:
+                    continue
+                update_attempts = attempts.get(update["update_id"], 0) + 1
+                if update_attempts >= max_attempts:
+                    given_up.append(update)
+                    continue
+                self.conn.execute(
+                    "INSERT INTO retry_update VALUES (?, ?, ?, ?)",
+                    (update["update_id"], chat_id, update_attempts, json.dumps(update)),
+                )
+        return given_up
+
+    def reports_sent(self, report_date):
+        """Participants that already got the daily report of report_date (ISO date)"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT participant_id FROM report_ledger WHERE report_date = ?",
+                (report_date,),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_reports_sent(self, report_date, participant_ids):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO report_ledger (report_date, participant_id) "
+                "VALUES (?, ?)",
+                [
+                    (report_date, str(participant_id))
+                    for participant_id in participant_ids
+                ],
+            )
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,78 @@
+import io
+import os
+import json
+import hashlib
+import metrics
+import pandas as pd
+import seaborn as sns
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+plot_history = 14  # rendered plots kept on disk per kind, see prune_plots
+figure_size = [8.06, 4.51]  # inches
+dpi = 150
+
+
+def render_barplot(values, label, line=None):
+    """
+    PNG of a horizontal barplot of the values of each participant, with a
+    vertical line at line. The figure is drawn by Agg on its own canvas, without
+    the global state of pyplot, so it is freed as soon as the PNG is written
+    """
+    df = pd.DataFrame.from_dict(values, orient="index", columns=[label])
+    fig = Figure(constrained_layout=True, figsize=figure_size)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots(1, 1)
+    sns.barplot(y=df.index, x=df[label], ax=ax)
+    if line is not None:
+        ax.axvline(x=line)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=dpi)
+    return buffer.getvalue()
+
+
+def cached_plot(directory, kind, values, label, line=None, decimals=None):
+    """
+    PNG of render_barplot, rendered again only if the values changed since one
+    of the plots kept in directory (named after the kind and a digest of the
+    values). With decimals the values are plotted rounded, e.g. the days since
+    the last vote grow at every run but the plot only changes once a day
+    """
+    if decimals is not None:
+        values = {
+            participant_id: round(value, decimals)
+            for participant_id, value in values.items()
+        }
+    key = json.dumps([sorted(values.items()), label, line], default=str)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    location = os.path.join(directory, f"{kind}_{digest}.png")
+    if os.path.exists(location):
+        metrics.count("plot_cache_hits")
+        # the plot is recent again for prune_plots
+        os.utime(location)
+        with open(location, "rb") as f:
+            return f.read()
+
+    with metrics.timer("render"):
+        png = render_barplot(values, label, line)
+    os.makedirs(directory, exist_ok=True)
+    # a plot that is half written must never be read as cached
+    tmp_location = f"{location}.tmp"
+    with open(tmp_location, "wb") as f:
+        f.write(png)
+    os.replace(tmp_location, location)
+    prune_plots(directory, kind)
+    return png
+
+
+def prune_plots(directory, kind, keep=plot_history):
+    """Delete all but the keep most recently used plots of the kind"""
+    locations = [
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(f"{kind}_") and name.endswith(".png")
+    ]
+    locations.sort(key=os.path.getmtime, reverse=True)
+    for location in locations[keep:]:
+        os.remove(location)
@@ -0,0 +1,91 @@
+import threading
+import collections
+
+# https://api.slack.com/reference/block-kit/blocks
+max_section_chars = 3000  # text of a section block
+max_blocks = 50  # blocks of a message
+levels = ["Error", "Warning", "Info"]  # order of the groups in the digest
+
+
+class SlackDigest:
+    """
+    Slack notifications of a run, posted at the end as a few Block Kit messages
+    grouped by level instead of one webhook post each. Errors with the same
+    signature (e.g. exception type and line) are posted once with the list of
+    the participants they happened to
+    """
+
+    def __init__(self):
+        self.msgs = collections.defaultdict(list)  # per level
+        self.errors = {}  # signature -> [msg, participants]
+        self.lock = threading.Lock()
+
+    def add(self, msg, msg_level="Info"):
+        with self.lock:
+            self.msgs[msg_level].append(msg)
+
+    def add_error(self, signature, msg, participant_id):
+        with self.lock:
+            error = self.errors.setdefault(signature, [msg, []])
+            error[1].append(participant_id)
+
+    def extend(self, digest):
+        """Add the notifications of a participant, see process_participant"""
+        with self.lock:
+            for msg_level, msgs in digest.msgs.items():
+                self.msgs[msg_level].extend(msgs)
+            for signature, (msg, participants) in digest.errors.items():
+                error = self.errors.setdefault(signature, [msg, []])
+                error[1].extend(participants)
+
+    def __len__(self):
+        return sum(len(msgs) for msgs in self.msgs.values()) + len(self.errors)
+
+    def grouped_msgs(self):
+        """Messages of each level, the deduplicated errors first"""
+        grouped = collections.defaultdict(list)
+        for msg, participants in self.errors.values():
+            if len(participants) > 1:
+                msg += f"\n_{len(participants)} participants: {', '.join(map(str, participants))}_"
+            grouped["Error"].append(msg)
+        for msg_level, msgs in self.msgs.items():
+            grouped[msg_level].extend(msgs)
+        order = {msg_level: i for i, msg_level in enumerate(levels)}
+        return sorted(grouped.items(), key=lambda item: order.get(item[0], len(levels)))
+
+    def payloads(self, reference_app="Telegram-bot"):
+        """
+        Webhook payloads of the digest: for each level a header and the messages
+        in sections of up to max_section_chars, split in as many messages as
+        needed to stay under max_blocks
+        """
+        payloads = []
+        for msg_level, msgs in self.grouped_msgs():
+            title = f"{reference_app} - {msg_level} ({len(msgs)})"
+            sections = []
+            for text in chunk_text(msgs, max_section_chars):
+                sections.append(
+                    {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+                )
+            for start in range(0, len(sections), max_blocks - 1):
+                blocks = [
+                    {"type": "header", "text": {"type": "plain_text", "text": title}}
+                ]
+                blocks.extend(sections[start : start + max_blocks - 1])
+                # the text is shown in the notifications
+                payloads.append({"text": title, "blocks": blocks})
+        return payloads
+
+
+def chunk_text(msgs, max_chars):
+    """Join the messages with blank lines in texts of up to max_chars, too long messages are cut"""
+    text = ""
+    for msg in msgs:
+        if len(msg) > max_chars:
+            msg = msg[: max_chars - 1] + "…"
+        if text and len(text) + 2 + len(msg) > max_chars:
+            yield text
+            text = ""
+        text = f"{text}\n\n{msg}" if text else msg
+    if text:
+        yield text
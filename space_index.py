@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class SpaceIndex:
+    """
+    Finds the space of Steerpath coordinates from the polygons of the spaces
+    (see space_polygons in space_names.py). The polygons are bucketed in a grid
+    of cells about the size of a space, so each point is only tested against
+    the few polygons of its cell instead of every space of the site
+    """
+
+    def __init__(self, polygons, cell_size=None):
+        """polygons maps a space_id to its vertices, a list of (longitude, latitude)"""
+        self.space_ids = list(polygons)
+        self.vertices = [
+            np.asarray(polygons[space_id], dtype=float) for space_id in self.space_ids
+        ]
+        bounds = np.array(
+            [
+                [v[:, 0].min(), v[:, 1].min(), v[:, 0].max(), v[:, 1].max()]
+                for v in self.vertices
+            ]
+        )
+        self.origin = bounds[:, :2].min(axis=0)
+        if cell_size is None:
+            # the median extent of the spaces, a space covers a few cells at most
+            cell_size = np.median(
+                np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+            )
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+
+        # cell -> polygons whose bounding box overlaps it
+        self.cells = {}
+        first_cells = self.cell_of(bounds[:, 0], bounds[:, 1])
+        last_cells = self.cell_of(bounds[:, 2], bounds[:, 3])
+        for i, ((x0, y0), (x1, y1)) in enumerate(zip(first_cells, last_cells)):
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    self.cells.setdefault((x, y), []).append(i)
+
+    def cell_of(self, longitudes, latitudes):
+        cells = np.floor(
+            (np.column_stack([longitudes, latitudes]) - self.origin) / self.cell_size
+        )
+        return cells.astype(np.int64)
+
+    def locate(self, longitudes, latitudes):
+        """
+        space_id of each point (None if it is in no space), the first space in
+        space_polygons wins where spaces overlap
+        """
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        located = np.full(len(longitudes), None, dtype=object)
+        if len(longitudes) == 0:
+            return located
+
+        # the points of a cell are tested together against its polygons
+        cells = self.cell_of(longitudes, latitudes)
+        unique_cells, cell_points = np.unique(cells, axis=0, return_inverse=True)
+        cell_points = cell_points.reshape(-1)
+        order = np.argsort(cell_points, kind="stable")
+        splits = np.cumsum(np.bincount(cell_points))[:-1]
+        for cell, points in zip(map(tuple, unique_cells), np.split(order, splits)):
+            for i in self.cells.get(cell, []):
+                inside = contains(
+                    self.vertices[i], longitudes[points], latitudes[points]
+                )
+                located[points[inside]] = self.space_ids[i]
+                points = points[~inside]
+                if len(points) == 0:
+                    break
+        return located
+
+
+def contains(vertices, x, y):
+    """Whether the points (x, y) are inside the polygon, by counting the edges crossed by a ray (even-odd rule)"""
+    x1, y1 = vertices[:, 0], vertices[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    y = y[:, None]
+    crosses = (y1 > y) != (y2 > y)
+    # horizontal edges never cross the ray, their division is discarded
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+    return np.count_nonzero(crosses & (x[:, None] < x_cross), axis=1) % 2 == 1
@@ -2,3 +2,10 @@ space_names = {
     -1: "outdoor",
     # TODO
 }
+
+# optional geometry of the spaces, space_id -> vertices [(longitude, latitude), ...].
+# The votes without Space_id (incomplete geofencing) are matched to these
+# polygons before falling back to outdoor (see space_index.py)
+space_polygons = {
+    # TODO
+}
@@ -0,0 +1,90 @@
+import os
+import json
+import importlib
+import credentials as cd
+
+# settings that can change from one study to the other, see Study
+study_settings = [
+    "experiment_name",
+    "user_id_file",
+    "time_zone",
+    "token",
+    "database",
+    "measurement",
+    "slack_webhook_url",
+    "slack_token",
+    "slack_channel",
+    "space_names",
+    "report_hour",
+    "export",
+]
+report_hour = 10  # default daily report time in UTC
+space_names_module = "space_names"  # default mapping from space_id to space name
+
+
+class Study:
+    """
+    Settings of one experiment (telegram bot, Influx measurement, participants,
+    spaces...). The settings that are not given fall back to credentials.py.
+    The state files of the study (ledger, outbox, report state, metrics, logs)
+    are kept in its directory
+    """
+
+    def __init__(self, name, directory, **settings):
+        unknown_settings = set(settings) - set(study_settings)
+        if unknown_settings:
+            raise ValueError(
+                f"Unknown settings for study {name}: {sorted(unknown_settings)}"
+            )
+        self.name = name
+        self.directory = directory
+        for setting in study_settings:
+            setattr(self, setting, settings.get(setting, getattr(cd, setting, None)))
+        if self.report_hour is None:
+            self.report_hour = report_hour
+        self.user_id_file = self.path(self.user_id_file)
+        # space_names is the name of a module like space_names.py
+        spaces_module = importlib.import_module(self.space_names or space_names_module)
+        self.space_names = spaces_module.space_names
+        self.space_polygons = getattr(spaces_module, "space_polygons", {})
+        unknown_spaces = set(self.space_polygons) - set(self.space_names)
+        if unknown_spaces:
+            raise ValueError(
+                f"Polygons of spaces missing in space_names for study {name}: {sorted(unknown_spaces)}"
+            )
+
+    def path(self, *names):
+        """Location of a file of the study"""
+        return os.path.join(self.directory, *names)
+
+
+def default_study():
+    """The study configured in credentials.py, with its files in the working directory"""
+    return Study("main", os.getcwd())
+
+
+def load_studies(location):
+    """
+    Studies defined in a JSON file: a list of objects with a name, a directory
+    for the state files and any of the study_settings. A relative directory is
+    relative to the JSON file
+    """
+    with open(location) as f:
+        definitions = json.load(f)
+
+    studies = []
+    for definition in definitions:
+        definition = dict(definition)
+        name = definition.pop("name")
+        directory = os.path.join(
+            os.path.dirname(os.path.abspath(location)),
+            definition.pop("directory", name),
+        )
+        os.makedirs(directory, exist_ok=True)
+        studies.append(Study(name, directory, **definition))
+
+    names = [study.name for study in studies]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicated study names in {location}")
+
+    return studies
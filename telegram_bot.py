@@ -1,17 +1,26 @@
 import os
 import sys
+import csv
 import json
 import time
+import fcntl
+import asyncio
+import argparse
+import functools
 import logging
-import requests
-import pandas as pd
-import seaborn as sns
-import credentials as cd
-
-from user_progress import *
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-import collections.abc
+import threading
+import metrics
+
+# pandas, Influx and the plotting libraries take most of the start up time,
+# they are only imported by the functions that need them (see get_user_progress)
+from transport import get_session, close_session, run_bounded
+from message_queue import OutboundQueue, MessageBuffer
+from slack_digest import SlackDigest
+from commands import router
+from msg_store import MsgStore
+from studies import default_study, load_studies
+from datetime import datetime, timedelta, timezone
+import collections
 from logging.handlers import RotatingFileHandler
 
 
@@ -49,95 +58,96 @@ def init_logger(log_file_location, name="main", limit_log_file_size=True):
     return app_log
 
 
-def init_msg_logs(log_file_location):
-    """open file containing message logs, if it doesn't exist create one"""
-    try:
-        log_msg = json.load(open(log_file_location))
-    except FileNotFoundError:
-        log_msg = dict()
-        json.dump(log_msg, open(log_file_location, "w"))
+def get_updates(study, offset, logger, timeout=0):
+    """
+    Fetch every update not yet acknowledged to telegram in a single request.
+    With timeout > 0 telegram holds the request open until an update arrives (long polling).
+    Raises ValueError if telegram returns an error (bad token, conflicting
+    getUpdates, server error), unlike an empty list which means no new update
+    """
+    with metrics.timer("telegram_updates"):
+        response = get_session().get(
+            f"https://api.telegram.org/bot{study.token}/getUpdates",
+            params={"offset": offset, "timeout": timeout},
+            timeout=timeout + 10,
+        )
+    if response.status_code != 200:
+        raise ValueError(
+            f"getUpdates returned status code {response.status_code}: {response.text}"
+        )
 
-    return log_file_location
+    all_incoming_msgs = response.json()["result"]
+    logger.info(f"all messages: {all_incoming_msgs}")
 
+    return all_incoming_msgs
 
-def update(d, u, save_location):
-    """Update a dictionary without overriding existing keys and/or fields"""
-    for k, v in u.items():
-        if isinstance(v, collections.abc.Mapping):
-            d[k] = update(d.get(k, {}), v, save_location)
-        else:
-            d[k] = v
-    json.dump(d, open(save_location, "w"))
 
-    return d
+def index_msgs_by_chat(all_incoming_msgs):
+    """Group the incoming messages by the telegram id of their sender"""
+    msgs_by_chat = collections.defaultdict(list)
+    for msg_user in all_incoming_msgs:
+        # after changes in the API about chat members, updates without a message are possible
+        if "message" in msg_user.keys():
+            msgs_by_chat[msg_user["message"]["from"]["id"]].append(msg_user)
 
+    return msgs_by_chat
 
-def read_user_msg(
-    chat_id, participant_id, vote_timestamp, log_msg_location, logger, logger_msg_sent
-):
-    # dictionary of commands and their responses
-    telegram_available_requests = {"help": {}}
-    telegram_available_requests["last vote"] = {
-        "description": "Returns the date and time of the last fitbit response",
-        "return": vote_timestamp.strftime("%b-%d %H:%M")
-        if vote_timestamp is not None
-        else "Error",
-    }
-    help_msg = (
-        f"Welcome to the {cd.experiment_name} experiment. This telegram bot "
-        + "will be used to automatically send you messages about your progress "
-        + "during the experiment. In addition you can chat with the bot and "
-        + "ask a predefined set of questions.\n\n"
-        + 'Type and send "help" if you want to know the list of available '
-        + "commands you can ask bo the Bot\n\n"
-        + "Please remember that the Bot won't be able to answer any other "
-        + "request. Hence, please contact the research team via the designated "
-        + "telegram group. There might be a delay of a few minutes between "
-        + "the time you type and send a request and the time you receive and answer. "
-        + f"Thank you once again for participating in the {cd.experiment_name} experiment."
-    )
-    telegram_available_requests["/start"] = {
-        "description": "Message when the user initiate a conversation with the Bot",
-        "return": help_msg,
-    }
-    telegram_available_requests["help"] = {
-        "description": "Returns list of available requests",
-        "return": f'List of available requests: {str(", ".join(list(telegram_available_requests.keys())))}',
-    }
-    # open logs of previous messages
-    log_msg = json.load(open(log_msg_location))
-    # get telegram response
-    response = requests.get(f"https://api.telegram.org/bot{cd.token}/getUpdates")
 
-    if response.status_code == 200:
-        all_incoming_msgs = response.json()["result"]
-        logger.info(f"all messages: {all_incoming_msgs}")
+def next_update_offset(all_incoming_msgs, offset):
+    """
+    Offset that acknowledges all the updates received in this run, the ones
+    that could not be handled are kept in the store instead (see keep_for_retry)
+    """
+    if not all_incoming_msgs:
+        return offset
+
+    return max(msg["update_id"] for msg in all_incoming_msgs) + 1
+
 
-        msgs_user = []
-        for msg_user in all_incoming_msgs:
-            if "message" in msg_user.keys():
-                if msg_user["message"]["from"]["id"] == chat_id:
-                    msgs_user.append(msg_user)
+def with_retry_updates(msg_store, all_incoming_msgs):
+    """The new updates after the ones of previous runs that could not be handled"""
+    updates = {msg["update_id"]: msg for msg in msg_store.retry_updates()}
+    updates.update((msg["update_id"], msg) for msg in all_incoming_msgs)
+    return [updates[update_id] for update_id in sorted(updates)]
 
-        # after changes in the API about chat members
-        # msgs_user = [msg_user for msg_user in all_incoming_msgs if msg_user['message']['from']['id'] == chat_id]
 
+def keep_for_retry(msg_store, incoming_msgs, failed_chats, logger):
+    """
+    Keep the updates of the chats that could not be handled for the next run,
+    the messages already answered are skipped thanks to the last handled
+    message id of each chat
+    """
+    given_up = msg_store.set_retry_updates(
+        incoming_msgs, failed_chats, max_update_attempts
+    )
+    for msg in given_up:
+        logger.error(
+            f"Giving up the telegram update {msg['update_id']} after {max_update_attempts} attempts"
+        )
+
+
+def read_user_msg(
+    study,
+    chat_id,
+    participant_id,
+    last_vote,
+    msgs_user,
+    msg_store,
+    logger,
+    logger_msg_sent,
+):
+    """
+    Answer the new messages of a chat with the commands of commands.router,
+    last_vote returns the timestamp of the last vote of the participant and is
+    only called if a command needs it
+    """
+    # msgs_user holds the messages of this chat from the single getUpdates call of the run
+    if msgs_user:
         # get the last incoming message id from telegram that has already been processed
-        try:
-            last_handled_msg_id = log_msg[str(chat_id)]["incoming_msg"]["telegram_chat"]
-        except KeyError:
-            try:
-                oldest_id = msgs_user[0]["message"]["message_id"] - 1
-                logger.info("MESSAGE ID DECREASED BY 1")
-            except IndexError:
-                oldest_id = 0
-
-            log_msg = update(
-                log_msg,
-                {str(chat_id): {"incoming_msg": {"telegram_chat": oldest_id}}},
-                log_msg_location,
-            )
-            last_handled_msg_id = log_msg[str(chat_id)]["incoming_msg"]["telegram_chat"]
+        last_handled_msg_id = msg_store.last_handled_msg_id(chat_id)
+        if last_handled_msg_id is None:
+            last_handled_msg_id = msgs_user[0]["message"]["message_id"] - 1
+            logger.info("MESSAGE ID DECREASED BY 1")
 
         logger.info(f"old message id: {last_handled_msg_id}")
         # go through all the received messages but only respond the last one
@@ -154,53 +164,34 @@ def read_user_msg(
                 continue
             logger.info(f"Telegram bot received a new message: {text_message}")
 
-            # if the user asked something that the bot does not know, send him list of available quesitons
-            if text_message not in telegram_available_requests.keys():
-                send_text(
-                    "The bot cannot answer this request. List of available requests:",
-                    chat_id,
-                    logger,
-                    logger_msg_sent,
-                )
-                for key in telegram_available_requests.keys():
-                    message = (
-                        key + ": " + telegram_available_requests[key]["description"]
-                    )
-                    send_text(message, participant_id, logger, logger_msg_sent)
-
-            for key in telegram_available_requests.keys():
-                if text_message == key:
-                    send_text(
-                        f"You have asked the bot for {key}:",
-                        chat_id,
-                        logger,
-                        logger_msg_sent,
-                    )
-                    send_text(
-                        telegram_available_requests[key]["return"],
-                        chat_id,
-                        logger,
-                        logger_msg_sent,
-                    )
+            send_text(
+                study,
+                router.reply(text_message, study, participant_id, last_vote),
+                chat_id,
+                logger,
+                logger_msg_sent,
+            )
 
-            log_msg = update(
-                log_msg,
-                {
-                    str(chat_id): {
-                        "incoming_msg": {
-                            "telegram_chat": msg_to_process["message"]["message_id"]
-                        }
-                    }
-                },
-                log_msg_location,
+            msg_store.set_last_handled_msg_id(
+                chat_id, msg_to_process["message"]["message_id"]
             )
 
 
-def send_text(msg, telegram_id, logger, logger_msg_sent):
-    """Format string message to send via telegram"""
-    token = cd.token
-    send_text = f"https://api.telegram.org/bot{token}/sendMessage?chat_id={telegram_id}&parse_mode=Markdown&text={msg}"
-    response = requests.get(send_text)
+def send_text(study, msg, telegram_id, logger, logger_msg_sent, outbox=None):
+    """
+    Format string message to send via telegram.
+    If an outbox is given the message is only queued there (see OutboundQueue)
+    """
+    if outbox is not None:
+        outbox.put(msg, telegram_id)
+        return None
+
+    token = study.token
+    with metrics.timer("telegram"):
+        response = get_session().get(
+            f"https://api.telegram.org/bot{token}/sendMessage",
+            params={"chat_id": telegram_id, "parse_mode": "Markdown", "text": msg},
+        )
     logger.info(f"Telegram message to telegram_id: {telegram_id}, message: {msg}")
     logger_msg_sent.info(f"##telegram_id: {telegram_id}, message: {msg}")
 
@@ -208,42 +199,68 @@ def send_text(msg, telegram_id, logger, logger_msg_sent):
 
 
 def send_data_slack_channel(
-    msg, reference_app="Telegram-bot", msg_level="Error", image=False
+    study,
+    msg,
+    reference_app="Telegram-bot",
+    msg_level="Error",
+    image=None,
+    digest=None,
 ):
     """
     This function sends data to Slack webhooks in Python with the requests module.
     Detailed documentation of Slack Incoming Webhooks:
     - https://api.slack.com/incoming-webhooks
     - https://api.slack.com/messaging/webhooks#posting_with_webhooks
+    The message is added to digest instead if given (see SlackDigest)
     """
+    if digest is not None and image is None:
+        digest.add(msg, msg_level)
+        return
 
     # sending an image is slightly different, treat it separately
-    if image:
-        # msg here is the filename
-        f = {"file": (msg, open(msg, "rb"), "image/png", {"Expires": "0"})}
-        response = requests.post(
-            url="https://slack.com/api/files.upload",
-            data={"token": cd.slack_token, "channels": cd.slack_channel, "media": f},
-            headers={"Accept": "application/json"},
-            files=f,
-        )
+    if image is not None:
+        # msg here is the filename and image the PNG
+        f = {
+            "file": (
+                msg,
+                image,
+                "image/png",
+                {"Expires": "0"},
+            )
+        }
+        with metrics.timer("slack"):
+            response = get_session().post(
+                url="https://slack.com/api/files.upload",
+                data={
+                    "token": study.slack_token,
+                    "channels": study.slack_channel,
+                    "media": f,
+                },
+                headers={"Accept": "application/json"},
+                files=f,
+            )
         return response.text
 
-    # set the webhook_url to the one provided by Slack when you create the webhook at https://my.slack.com/services/new/incoming-webhook/
     if msg_level == "Error":
         color = "red"
 
-    webhook_url = cd.slack_webhook_url
     slack_data = {
         "type": "mrkdwn",
         "text": f"*{reference_app}* - `{msg_level}` - {msg}",
     }
+    return post_slack_webhook(study, slack_data)
 
-    response = requests.post(
-        webhook_url,
-        data=json.dumps(slack_data),
-        headers={"Content-Type": "application/json"},
-    )
+
+def post_slack_webhook(study, slack_data):
+    """Post a payload to the webhook of the study, raises ValueError if slack rejects it"""
+    # set the webhook_url to the one provided by Slack when you create the webhook at https://my.slack.com/services/new/incoming-webhook/
+    webhook_url = study.slack_webhook_url
+    with metrics.timer("slack"):
+        response = get_session().post(
+            webhook_url,
+            data=json.dumps(slack_data),
+            headers={"Content-Type": "application/json"},
+        )
     if response.status_code != 200:
         raise ValueError(
             "Request to slack returned an error %s, the response is:\n%s"
@@ -253,167 +270,826 @@ def send_data_slack_channel(
     return response.text
 
 
-#####
-debugging = False  # DEBUGGING
+def flush_slack_digest(study, digest, logger):
+    """
+    Post the notifications collected during the run, a few webhook calls
+    whatever the number of participants. A rejected message is logged and the
+    others are still posted
+    """
+    for slack_data in digest.payloads():
+        try:
+            post_slack_webhook(study, slack_data)
+        except Exception as e:
+            logger.error(f"Could not post the slack digest: {e}")
 
-#####
-# start loggers
-logger = init_logger(os.path.join(os.getcwd(), "logs.log"))
-logger.info("===============")
-logger_msg_sent = init_logger(
-    os.path.join(os.getcwd(), "logs_msg_sent.log"),
-    name="telegram_logger",
-    limit_log_file_size=False,
-)
-
-# start messages logs
-logs_msg_location = init_msg_logs(os.path.join(os.getcwd(), "logs_msg.json"))
-
-##### analyze each participant
-# get current list of participants
-df_users = pd.read_csv(cd.user_id_file)
-
-if debugging:
-    list_participants = ["enth28", "esk04"]
-else:
-    list_participants = df_users["user"].unique()
-
-# dictionary to store the users and their respective votes
-users_votes = {}
-users_last_vote_time = {}
-users_last_vote_unit = {}
-
-# only send automatic messages to the participant and to slack at 6pm (UTC + 8) +/- 1min
-threshold = pd.Timestamp.now().replace(hour=10, minute=0, second=0)  # 10am in UTC
-cur_time = pd.Timestamp.now()
-is_time = cur_time >= threshold - timedelta(
-    minutes=1
-) and cur_time <= threshold + timedelta(minutes=1)
-send_plots = False
-no_data = False
-
-for participant_id in list_participants:
+
+def acquire_run_lock(location):
+    """
+    Lock held for the whole run so slow runs never overlap with the next one.
+    Returns None if another run holds it
+    """
+    lock_file = open(location, "w")
     try:
-        user_data = df_users[df_users["user"] == participant_id].to_dict("records")[
-            0
-        ]  # only one row
-        logger.info(f"=== Analysing user: {participant_id}")
-        user_progress = UserProgress(
-            min_votes=80, min_time_between_votes=14, loc_threshold_time_tol=14
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+
+    return lock_file
+
+
+def read_participants(location):
+    """Participants and their telegram chat_id, from the chat_ids.csv file"""
+    with open(location, newline="") as f:
+        return [
+            {"chat_id": int(row["chat_id"]), "user": row["user"]}
+            for row in csv.DictReader(f)
+        ]
+
+
+def get_user_progress(study):
+    """
+    UserProgress of the study, every study shares the same Influx client. They
+    are created on first use, so runs that don't query Influx never load pandas
+    and influxdb
+    """
+    global _influx_cl
+    with _user_progress_lock:
+        if study.name not in _user_progress:
+            from user_progress import UserProgress, connect_influx
+            from influx_cache import InfluxCache
+
+            if _influx_cl is None:
+                _influx_cl = connect_influx()
+            _user_progress[study.name] = UserProgress(
+                min_votes=80,
+                min_time_between_votes=14,
+                loc_threshold_time_tol=14,
+                influx_cl=_influx_cl,
+                study=study,
+                cache=InfluxCache(study.path(influx_cache_file), ttl=influx_cache_ttl),
+            )
+        return _user_progress[study.name]
+
+
+def close_user_progress():
+    global _influx_cl
+    with _user_progress_lock:
+        if _influx_cl is not None:
+            _influx_cl.close()
+            _influx_cl = None
+        for user_progress in _user_progress.values():
+            user_progress.cache.close()
+        _user_progress.clear()
+
+
+def due_report_date(cur_time, report_hour):
+    """
+    Date (ISO format) of the last daily report that should have been sent by
+    cur_time (UTC). The report of a date is due from report_hour UTC of that date
+    """
+    threshold = cur_time.replace(hour=report_hour, minute=0, second=0, microsecond=0)
+    if cur_time < threshold:
+        threshold -= timedelta(days=1)
+
+    return threshold.date().isoformat()
+
+
+def seconds_until_next_report(cur_time, report_hour):
+    """Seconds to wait from cur_time until the next daily report is due"""
+    next_report = cur_time.replace(hour=report_hour, minute=0, second=0, microsecond=0)
+    if next_report <= cur_time:
+        next_report += timedelta(days=1)
+
+    return (next_report - cur_time).total_seconds()
+
+
+def analyse_participant(
+    study,
+    participant_id,
+    user_data,
+    user_progress,
+    cohort,
+    is_time,
+    msgs_user,
+    msg_store,
+    summary,
+    logger,
+    logger_msg_sent,
+    outbox=None,
+    digest=None,
+):
+    """
+    Notify a single participant about their progress and answer their commands.
+    cohort holds the data queried for all the participants at once (see fetch_cohort).
+    The commands are skipped if msgs_user is None, the report is only sent if is_time.
+    The notifications are queued in outbox if given (see OutboundQueue) and
+    the slack notifications collected in digest if given (see SlackDigest).
+    Returns True if the summary plots have to be sent.
+    """
+    send_plots = False
+    no_data = False
+    logger.info(f"=== Analysing user: {participant_id}")
+
+    # check last Cozie vote and notify the user if the vote was > 2 days ago
+    last_vote_time, time_units, vote_timestamp = cohort["last_votes"][participant_id]
+    if last_vote_time is None:
+        last_vote_msg = (
+            f"Hey {participant_id}, looks like there are no previous votes from you"
         )
+        logger.info(f"=== No data for {participant_id}")
+        no_data = True
+    else:
+        last_vote_msg = f"Last Cozie vote was {last_vote_time:.0f} {time_units} ago"
+        logger.info(f"=== {last_vote_msg}")
 
-        # check last Cozie vote and notify the user if the vote was > 2 days ago
-        last_vote_time, time_units, vote_timestamp = user_progress.last_vote(
-            participant_id
+    if debugging:
+        send_text(
+            study, last_vote_msg, user_data["chat_id"], logger, logger_msg_sent, outbox
         )
-        if last_vote_time is None:
-            last_vote_msg = (
-                f"Hey {participant_id}, looks like there are no previous votes from you"
-            )
-            logger.info(f"=== No data for {participant_id}")
-            no_data = True
-        else:
-            last_vote_msg = f"Last Cozie vote was {last_vote_time:.0f} {time_units} ago"
-            logger.info(f"=== {last_vote_msg}")
-
-        if debugging:
-            send_text(last_vote_msg, user_data["chat_id"], logger, logger_msg_sent)
-            logger.info(f"=== forced message sent to {participant_id}")
-            if not no_data:
-                msg, num_votes = user_progress.daily_report(participant_id)
-                send_text(msg, user_data["chat_id"], logger, logger_msg_sent)
-                logger.info(f"=== forced report sent to {participant_id}")
-
-        if time_units == "days" and not debugging and is_time:
-            send_plots = True
-            send_text(last_vote_msg, user_data["chat_id"], logger, logger_msg_sent)
-            send_data_slack_channel(
-                f"Last vote for participant {participant_id} was {last_vote_time:.0f} {time_units} ago",
-                msg_level="Error",
+        logger.info(f"=== forced message sent to {participant_id}")
+        if not no_data:
+            msg, num_votes = user_progress.daily_report(
+                participant_id,
+                cohort["thermal"].get(participant_id),
+                cohort["location"].get(participant_id),
+                cohort["report_state"].setdefault(participant_id, {}),
             )
+            send_text(study, msg, user_data["chat_id"], logger, logger_msg_sent, outbox)
+            logger.info(f"=== forced report sent to {participant_id}")
+
+    if time_units == "days" and not debugging and is_time:
+        send_plots = True
+        send_text(
+            study, last_vote_msg, user_data["chat_id"], logger, logger_msg_sent, outbox
+        )
+        send_data_slack_channel(
+            study,
+            f"Last vote for participant {participant_id} was {last_vote_time:.0f} {time_units} ago",
+            msg_level="Error",
+            digest=digest,
+        )
 
-        # check if the user typed asking for the type of the last vote
+    # check if the user typed asking for the type of the last vote
+    if msgs_user is not None:
         read_user_msg(
+            study,
             user_data["chat_id"],
             participant_id,
-            vote_timestamp,
-            logs_msg_location,
+            lambda: vote_timestamp,
+            msgs_user,
+            msg_store,
             logger,
             logger_msg_sent,
         )
 
-        # send progress summaries (only at 6pm with a tolerance of 2min)
-        if is_time and participant_id != "test":
-            if no_data:
-                msg = last_vote_msg
-                num_votes = 0
-            else:
-                msg, num_votes = user_progress.daily_report(participant_id)
-
-            send_plots = True
-            send_text(msg, user_data["chat_id"], logger, logger_msg_sent)
-
-            if not debugging:  # otherwise it will spam the slack channel in every run
-                send_data_slack_channel(msg, msg_level="Info")
-                # check if participant finished the experiment
-                if num_votes >= user_progress.min_votes:
-                    send_data_slack_channel(
-                        f"Participant {participant_id} just finished all required datapoints!",
-                        msg_level="Info",
-                    )
+    # send progress summaries (only at 6pm with a tolerance of 2min)
+    if is_time and participant_id != "test":
+        if no_data:
+            msg = last_vote_msg
+            num_votes = 0
+        else:
+            msg, num_votes = user_progress.daily_report(
+                participant_id,
+                cohort["thermal"].get(participant_id),
+                cohort["location"].get(participant_id),
+                cohort["report_state"].setdefault(participant_id, {}),
+            )
+
+        send_plots = True
+        send_text(study, msg, user_data["chat_id"], logger, logger_msg_sent, outbox)
 
-            # update user-votes dictionary for slack plots
-            users_votes[participant_id] = num_votes
-            users_last_vote_unit[participant_id] = time_units
-            if time_units == "days":  # daily votes plot only shows days
-                users_last_vote_time[participant_id] = last_vote_time
-            else:
-                users_last_vote_time[participant_id] = 0
+        if not debugging:  # otherwise it will spam the slack channel in every run
+            send_data_slack_channel(study, msg, msg_level="Info", digest=digest)
+            # check if participant finished the experiment
+            if num_votes >= user_progress.min_votes:
+                send_data_slack_channel(
+                    study,
+                    f"Participant {participant_id} just finished all required datapoints!",
+                    msg_level="Info",
+                    digest=digest,
+                )
+
+        # update user-votes dictionary for slack plots
+        summary["users_votes"][participant_id] = num_votes
+        summary["users_last_vote_unit"][participant_id] = time_units
+        if time_units == "days":  # daily votes plot only shows days
+            summary["users_last_vote_time"][participant_id] = last_vote_time
+        else:
+            summary["users_last_vote_time"][participant_id] = 0
+
+    return send_plots
+
+
+def process_participant(
+    study,
+    participant_id,
+    user_data,
+    user_progress,
+    cohort,
+    is_time,
+    msgs_by_chat,
+    msg_store,
+    logger,
+    logger_msg_sent,
+    digest,
+):
+    """
+    Worker of run_once for a single participant. The participant gets its own
+    summary, message buffer and slack notifications so an error only affects
+    this participant, the error itself is added to the digest of the run.
+    Returns is_time, whether the plots have to be sent, the summary, the
+    buffer and the notifications, or None if the analysis failed
+    """
+    summary = {
+        "users_votes": {},
+        "users_last_vote_time": {},
+        "users_last_vote_unit": {},
+    }
+    buffer = MessageBuffer()
+    notifications = SlackDigest()
+    try:
+        if user_data is None:
+            raise KeyError(f"{participant_id} not found in {study.user_id_file}")
+        msgs_user = (
+            msgs_by_chat.get(user_data["chat_id"], [])
+            if msgs_by_chat is not None
+            else None
+        )
+        with metrics.timer("participant", participant_id):
+            send_plots = analyse_participant(
+                study,
+                participant_id,
+                user_data,
+                user_progress,
+                cohort,
+                is_time,
+                msgs_user,
+                msg_store,
+                summary,
+                logger,
+                logger_msg_sent,
+                buffer,
+                notifications,
+            )
 
     except Exception as e:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        logger.error("Code stopped with error below:")
-        logger.error(exc_type, f_name, exc_tb.tb_lineno)
-        if (
-            not debugging
-        ):  # otherwise it will spam the slack channel with any small error
-            send_data_slack_channel(
-                f"Coded stopped with error - {participant_id} : {exc_type, f_name, exc_obj, exc_tb.tb_lineno}",
-                msg_level="Error",
+        metrics.count("errors", participant=participant_id)
+        report_participant_error(study, participant_id, logger, digest)
+        return None
+
+    return is_time, send_plots, summary, buffer, notifications
+
+
+def fetch_cohort(user_progress, list_participants, due_participants, report_state):
+    """
+    Query the data of all the participants at once instead of once per participant.
+    The history is only needed to compute the daily report of due_participants,
+    and only after the oldest watermark of the incremental report state. The
+    participants without state are left out, daily_report streams their whole
+    history in chunks
+    """
+    import pandas as pd
+
+    cohort = {
+        "last_votes": user_progress.last_votes(list_participants),
+        "report_state": report_state,
+        "thermal": {},
+        "location": {},
+    }
+    history_participants = list_participants if debugging else due_participants
+    watermarks = {
+        participant_id: report_state[participant_id]["watermark"]
+        for participant_id in history_participants
+        if report_state.get(participant_id, {}).get("watermark")
+    }
+    if len(watermarks) > 0:
+        since = min(pd.Timestamp(watermark) for watermark in watermarks.values())
+        thermal, location = user_progress.cohort_history(list(watermarks), since)
+        # the participants without new votes get empty frames, not a query
+        for participant_id in watermarks:
+            cohort["thermal"][participant_id] = thermal.get(
+                participant_id, pd.DataFrame()
             )
+            cohort["location"][participant_id] = location.get(
+                participant_id, pd.DataFrame()
+            )
+    return cohort
 
-#####
-# generate summary plot
-if send_plots:
-    df_summary = pd.DataFrame.from_dict(
-        users_votes, orient="index", columns=["Total votes"]
-    )
-    plot_time = pd.Timestamp.now(cd.time_zone).strftime("%b-%d %H:%M")
 
-    fig, ax = plt.subplots(
-        1, 1, constrained_layout=True, sharey=True, figsize=[8.06, 4.51]
+def report_participant_error(study, participant_id, logger, digest=None):
+    """
+    Log the exception being handled and mirror it to slack. With a digest the
+    errors raised at the same line are posted once for all the participants
+    """
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    f_name = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+    logger.error("Code stopped with error below:")
+    logger.error(exc_type, f_name, exc_tb.tb_lineno)
+    if debugging:  # otherwise it will spam the slack channel with any small error
+        return
+    msg = f"Coded stopped with error - {participant_id} : {exc_type, f_name, exc_obj, exc_tb.tb_lineno}"
+    if digest is not None:
+        digest.add_error((exc_type, f_name, exc_tb.tb_lineno), msg, participant_id)
+    else:
+        send_data_slack_channel(study, msg, msg_level="Error")
+
+
+def send_summary_plots(study, users_votes, users_last_vote_time):
+    """
+    Plot the votes and the days since the last vote of every participant.
+    The plots are uploaded from memory, the last ones are kept in img/ and are
+    not rendered again while the votes don't change (see plots.cached_plot)
+    """
+    import pandas as pd
+    from plots import cached_plot
+
+    plot_time = pd.Timestamp.now(study.time_zone).strftime("%b-%d %H:%M")
+    summary_png = cached_plot(
+        study.path(img_dir), "summary_responses", users_votes, "Total votes", 80
     )
-    sns.barplot(y=df_summary.index, x=df_summary["Total votes"], ax=ax)
-    ax.axvline(x=80)
-    plt.savefig(f"img/summary_responses_{plot_time}.png", dpi=150)
-    plt.close(fig)
     if not debugging:  # otherwise it will spam the slack channel
-        send_data_slack_channel(f"img/summary_responses_{plot_time}.png", image=True)
+        send_data_slack_channel(
+            study, f"summary_responses_{plot_time}.png", image=summary_png
+        )
 
     # generate last vote plot
-    df_last_vote = pd.DataFrame.from_dict(
-        users_last_vote_time, orient="index", columns=["Days since last vote"]
-    )
-    fig, ax = plt.subplots(
-        1, 1, constrained_layout=True, sharey=True, figsize=[8.06, 4.51]
+    last_vote_png = cached_plot(
+        study.path(img_dir),
+        "last_vote",
+        users_last_vote_time,
+        "Days since last vote",
+        decimals=0,
     )
-    sns.barplot(y=df_last_vote.index, x=df_last_vote["Days since last vote"], ax=ax)
-    plt.savefig(f"img/last_vote_{plot_time}.png", dpi=150)
-    plt.close(fig)
     if not debugging:  # otherwise it will spam the slack channel
-        send_data_slack_channel(f"img/last_vote_{plot_time}.png", image=True)
+        send_data_slack_channel(
+            study, f"last_vote_{plot_time}.png", image=last_vote_png
+        )
+
+
+def run_once(
+    study,
+    msg_store,
+    logger,
+    logger_msg_sent,
+    read_msgs=True,
+    max_concurrency=1,
+    commands_only=False,
+    max_workers=1,
+):
+    """
+    Analyse every participant of the study once with the same UserProgress.
+    The daily report is sent to the participants that did not get the last due
+    report yet according to the ledger, however late the run is.
+    The incoming telegram messages are only answered if read_msgs.
+    The notifications are sent at the end of the run through the outbound queue,
+    to up to max_concurrency chats at once.
+    Up to max_workers participants are analysed at the same time.
+    If there is no report to send (or commands_only), only the commands are answered
+    and pandas and Influx are not even loaded unless a participant sent a message.
+    Returns whether work is left for a later run: due reports that failed or
+    messages that could not be delivered.
+    """
+    run_metrics = metrics.reset()
+
+    # fetch the incoming telegram messages once per run, only the ones not acknowledged yet
+    if read_msgs:
+        update_offset = msg_store.update_offset()
+        try:
+            all_incoming_msgs = get_updates(study, update_offset, logger)
+        except ValueError as e:
+            # the report doesn't wait for telegram, the commands are read by the next run
+            logger.error(str(e))
+            all_incoming_msgs = []
+        incoming_msgs = with_retry_updates(msg_store, all_incoming_msgs)
+        msgs_by_chat = index_msgs_by_chat(incoming_msgs)
+
+    ##### analyze each participant
+    # get current list of participants
+    participants = read_participants(study.user_id_file)
+    users_data = {user_data["user"]: user_data for user_data in participants}
+
+    if debugging:
+        list_participants = ["enth28", "esk04"]
+    else:
+        list_participants = list(users_data.keys())
+
+    # reports are sent exactly once per participant and date, whenever the run happens
+    report_date = due_report_date(datetime.now(timezone.utc), study.report_hour)
+    reports_sent = msg_store.reports_sent(report_date)
+    due_participants = [
+        participant_id
+        for participant_id in list_participants
+        if str(participant_id) not in reports_sent
+    ]
+    reported_participants = []
+
+    outbox = OutboundQueue(
+        study.path(outbox_file),
+        functools.partial(
+            send_text, study, logger=logger, logger_msg_sent=logger_msg_sent
+        ),
+        logger,
+    )
+
+    if commands_only or (not due_participants and not debugging):
+        # fast path, nothing to analyse
+        if read_msgs:
+            failed_chats = answer_commands(
+                study,
+                incoming_msgs,
+                participants,
+                msg_store,
+                logger,
+                logger_msg_sent,
+            )
+            msg_store.set_update_offset(
+                next_update_offset(all_incoming_msgs, update_offset)
+            )
+            keep_for_retry(msg_store, incoming_msgs, failed_chats, logger)
+            msg_store.commit()
+        # messages that could not be delivered in previous runs
+        outbox.flush(max_concurrency)
+        write_run_metrics(study, run_metrics, False, logger)
+        return bool(due_participants) or len(outbox) > 0
+
+    from user_progress import load_report_state, save_report_state
+
+    user_progress = get_user_progress(study)
+    report_state = load_report_state(study.path(report_state_file))
+    with metrics.timer("cohort"):
+        cohort = fetch_cohort(
+            user_progress, list_participants, due_participants, report_state
+        )
+
+    # dictionary to store the users and their respective votes
+    summary = {
+        "users_votes": {},
+        "users_last_vote_time": {},
+        "users_last_vote_unit": {},
+    }
+    send_plots = False
+    # slack notifications of the run, posted together at the end
+    digest = SlackDigest()
+
+    results = run_bounded(
+        [
+            functools.partial(
+                process_participant,
+                study,
+                participant_id,
+                users_data.get(participant_id),
+                user_progress,
+                cohort,
+                str(participant_id) not in reports_sent,
+                msgs_by_chat if read_msgs else None,
+                msg_store,
+                logger,
+                logger_msg_sent,
+                digest,
+            )
+            for participant_id in list_participants
+        ],
+        max_workers,
+    )
+    # merged in the order of the participants list, whatever order the workers finished in
+    failed_chats = set()
+    for participant_id, result in zip(list_participants, results):
+        if result is None or isinstance(result, Exception):
+            # the report is retried in the next run, its messages were not queued
+            # and its commands are read again
+            if participant_id in users_data:
+                failed_chats.add(users_data[participant_id]["chat_id"])
+            continue
+        (
+            is_time,
+            participant_send_plots,
+            participant_summary,
+            buffer,
+            notifications,
+        ) = result
+        outbox.extend(buffer)
+        digest.extend(notifications)
+        send_plots |= participant_send_plots
+        for key, values in participant_summary.items():
+            summary[key].update(values)
+        if is_time:
+            reported_participants.append(participant_id)
+
+    # the queued reports are on disk before they are recorded in the ledger,
+    # so they are delivered by a later run if this one dies while sending them
+    outbox.save()
+    msg_store.mark_reports_sent(report_date, reported_participants)
+    msg_store.commit()
+
+    # also retries the messages that could not be delivered in previous runs
+    with metrics.timer("outbox"):
+        outbox.flush(max_concurrency)
+
+    if due_participants or debugging:
+        save_report_state(report_state, study.path(report_state_file))
+
+    if read_msgs:
+        msg_store.set_update_offset(
+            next_update_offset(all_incoming_msgs, update_offset)
+        )
+        keep_for_retry(msg_store, incoming_msgs, failed_chats, logger)
+        # a single transaction for all the messages handled in this run
+        msg_store.commit()
+
+    flush_slack_digest(study, digest, logger)
+
+    #####
+    # generate summary plot
+    if send_plots:
+        with metrics.timer("plots"):
+            send_summary_plots(
+                study, summary["users_votes"], summary["users_last_vote_time"]
+            )
+
+    write_run_metrics(study, run_metrics, len(reported_participants) > 0, logger)
+    return (
+        len(set(due_participants) - set(reported_participants)) > 0 or len(outbox) > 0
+    )
+
+
+def write_run_metrics(study, run_metrics, sent_reports, logger):
+    """
+    Save the timings and counters of the run to track regressions, the latency
+    digest is only posted to slack for the daily report runs
+    """
+    try:
+        run_metrics.write_jsonl(study.path(metrics_jsonl_file))
+        run_metrics.write_prometheus(study.path(metrics_prometheus_file))
+    except OSError as e:
+        logger.error(f"Could not write the run metrics: {e}")
+
+    digest = run_metrics.digest()
+    logger.info(f"=== Run metrics: {digest}")
+    if sent_reports and not debugging:
+        send_data_slack_channel(study, f"Run latency: {digest}", msg_level="Info")
+
+
+def answer_commands(
+    study, all_incoming_msgs, participants, msg_store, logger, logger_msg_sent
+):
+    """
+    Answer the commands of the participants that sent a message, without reports.
+    Returns the chats whose messages could not be handled (see next_update_offset)
+    """
+    msgs_by_chat = index_msgs_by_chat(all_incoming_msgs)
+    users_with_msgs = [
+        user_data for user_data in participants if user_data["chat_id"] in msgs_by_chat
+    ]
+    failed_chats = set()
+    if not users_with_msgs:
+        return failed_chats
+
+    # the last votes are only queried if a participant asks for them, at once for all
+    @functools.lru_cache(maxsize=None)
+    def last_votes():
+        return get_user_progress(study).last_votes(
+            [user_data["user"] for user_data in users_with_msgs]
+        )
+
+    for user_data in users_with_msgs:
+        participant_id = user_data["user"]
+        msgs_user = msgs_by_chat[user_data["chat_id"]]
+        try:
+            read_user_msg(
+                study,
+                user_data["chat_id"],
+                participant_id,
+                lambda participant_id=participant_id: last_votes()[participant_id][2],
+                msgs_user,
+                msg_store,
+                logger,
+                logger_msg_sent,
+            )
+        except Exception as e:
+            failed_chats.add(user_data["chat_id"])
+            report_participant_error(study, participant_id, logger)
+
+    return failed_chats
+
+
+async def poll_commands(study, msg_store, logger, logger_msg_sent):
+    """Long-poll getUpdates and answer the commands as soon as they arrive"""
+    loop = asyncio.get_running_loop()
+    update_offset = msg_store.update_offset()
+    while True:
+        try:
+            all_incoming_msgs = await loop.run_in_executor(
+                None, get_updates, study, update_offset, logger, long_polling_timeout
+            )
+            # the updates that failed are retried at each poll, even without new ones
+            incoming_msgs = with_retry_updates(msg_store, all_incoming_msgs)
+            if not incoming_msgs:
+                continue
+            # the participants list can change while the daemon is running
+            participants = read_participants(study.user_id_file)
+            failed_chats = await loop.run_in_executor(
+                None,
+                answer_commands,
+                study,
+                incoming_msgs,
+                participants,
+                msg_store,
+                logger,
+                logger_msg_sent,
+            )
+            update_offset = next_update_offset(all_incoming_msgs, update_offset)
+            msg_store.set_update_offset(update_offset)
+            keep_for_retry(msg_store, incoming_msgs, failed_chats, logger)
+            msg_store.commit()
+        except Exception as e:
+            logger.error(f"Error while polling telegram updates: {e}")
+            await asyncio.sleep(long_polling_timeout)
+
+
+async def schedule_daily_report(
+    study, msg_store, logger, logger_msg_sent, max_concurrency, max_workers, run_lock
+):
+    """
+    Send the daily reports of the study that are due, starting with the ones
+    missed while the daemon was not running, then again at the report hour of
+    the study every day. The commands are answered by poll_commands.
+    While reports failed or messages could not be delivered, the run is
+    retried every report_retry_interval instead of waiting for the next day.
+    run_lock is shared by the studies, their runs don't overlap since the
+    metrics of a run are process wide
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        logger.info(f"=== Running scheduled daily report of {study.name}")
+        # a run that fails altogether is retried too
+        pending = True
+        try:
+            async with run_lock:
+                pending = await loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        run_once,
+                        study,
+                        msg_store,
+                        logger,
+                        logger_msg_sent,
+                        read_msgs=False,
+                        max_concurrency=max_concurrency,
+                        max_workers=max_workers,
+                    ),
+                )
+        except Exception as e:
+            logger.error(f"Scheduled daily report stopped with error: {e}")
+        delay = seconds_until_next_report(datetime.now(timezone.utc), study.report_hour)
+        if pending:
+            delay = min(delay, report_retry_interval)
+        await asyncio.sleep(delay)
+
+
+async def run_daemon(bots, max_concurrency, max_workers):
+    """
+    Answer the commands and send the daily report of every study until the process
+    is stopped. bots holds the study, msg_store, logger and logger_msg_sent of each study
+    """
+    run_lock = asyncio.Lock()
+    await asyncio.gather(
+        *(poll_commands(*bot) for bot in bots),
+        *(
+            schedule_daily_report(*bot, max_concurrency, max_workers, run_lock)
+            for bot in bots
+        ),
+    )
+
+
+#####
+debugging = False  # DEBUGGING
+long_polling_timeout = 30  # s
+max_update_attempts = 5  # runs a telegram update is handled in before it is dropped
+report_retry_interval = 5 * 60  # s, see schedule_daily_report
+run_lock_location = os.path.join(os.getcwd(), "telegram_bot.lock")
+# files of each study, in the directory of the study (see studies.py)
+report_state_file = "report_state.json"
+outbox_file = "outbox.json"
+metrics_jsonl_file = "metrics.jsonl"
+metrics_prometheus_file = "metrics.prom"
+influx_cache_file = "influx_cache.db"
+influx_cache_ttl = 60  # s, how long the query results and last votes are reused
+img_dir = "img"  # summary plots, see send_summary_plots
+_influx_cl = None  # see get_user_progress
+_user_progress = {}  # per study name
+_user_progress_lock = threading.Lock()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cozie telegram bot")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running, answer commands as they arrive and send the daily report at the report hour",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="recompute the incremental daily report state from the full history",
+    )
+    parser.add_argument(
+        "--commands-only",
+        action="store_true",
+        help="only answer the participants' commands, never send the daily report",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="number of chats the daily notifications are sent to at once",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of participants analysed at the same time",
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="export the localised votes of the daily report as Parquet files, "
+        "in the export directory of each study",
+    )
+    parser.add_argument(
+        "--studies",
+        help="JSON file with the studies served by this process (see studies.py), "
+        "by default the single study of credentials.py",
+    )
+    args = parser.parse_args()
+
+    studies = load_studies(args.studies) if args.studies else [default_study()]
+    if args.export:
+        for study in studies:
+            study.export = True
+
+    #####
+    # start loggers, one pair per study
+    loggers = {}
+    for study in studies:
+        logger = init_logger(study.path("logs.log"), name=study.name)
+        logger.info("===============")
+        logger_msg_sent = init_logger(
+            study.path("logs_msg_sent.log"),
+            name=f"telegram_{study.name}",
+            limit_log_file_size=False,
+        )
+        loggers[study.name] = (logger, logger_msg_sent)
+
+    run_lock = acquire_run_lock(run_lock_location)
+    if run_lock is None:
+        for logger, _ in loggers.values():
+            logger.info("Another run is still in progress, skipping this one")
+        return
+
+    bots = []
+    try:
+        for study in studies:
+            # start messages logs
+            msg_store = MsgStore(
+                study.path("logs_msg.db"),
+                json_location=study.path("logs_msg.json"),
+            )
+            bots.append((study, msg_store, *loggers[study.name]))
+
+            if args.rebuild and os.path.isfile(study.path(report_state_file)):
+                # the next daily report is recomputed from the full history
+                os.remove(study.path(report_state_file))
+
+        if args.daemon:
+            asyncio.run(run_daemon(bots, args.concurrency, args.workers))
+        else:
+            # automatic messages to the participants and to slack are sent once a day
+            # from the report hour, the ledger in msg_store avoids duplicates
+            for study, msg_store, logger, logger_msg_sent in bots:
+                try:
+                    run_once(
+                        study,
+                        msg_store,
+                        logger,
+                        logger_msg_sent,
+                        max_concurrency=args.concurrency,
+                        commands_only=args.commands_only,
+                        max_workers=args.workers,
+                    )
+                except Exception as e:
+                    # the other studies are still served
+                    logger.exception(f"Run of {study.name} stopped with error: {e}")
+    finally:
+        for _, msg_store, _, _ in bots:
+            msg_store.close()
+        close_user_progress()
+        close_session()
+        run_lock.close()
+
 
+if __name__ == "__main__":
+    main()
 
 # if the images are not needed for later, delete them
 # os.remove('summary_responses.png')
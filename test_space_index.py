@@ -0,0 +1,59 @@
+import warnings
+import unittest
+import numpy as np
+
+from space_index import SpaceIndex, contains
+
+
+def square(x, y, size):
+    return [(x, y), (x + size, y), (x + size, y + size), (x, y + size)]
+
+
+# a step: the horizontal edge from (4, 1) to (3, 1) is on the ray of the points at y=1
+step = np.array([(0, 0), (4, 0), (4, 1), (3, 1), (3, 3), (0, 3)], dtype=float)
+
+
+class SpaceIndexTest(unittest.TestCase):
+    def test_overlapping_polygons(self):
+        polygons = {"a": square(0, 0, 2), "b": square(1, 1, 2)}
+        longitudes, latitudes = [0.5, 1.5, 2.5], [0.5, 1.5, 2.5]
+        # the first space in space_polygons wins where they overlap
+        located = SpaceIndex(polygons).locate(longitudes, latitudes)
+        self.assertEqual(located.tolist(), ["a", "a", "b"])
+        reversed_polygons = dict(reversed(list(polygons.items())))
+        located = SpaceIndex(reversed_polygons).locate(longitudes, latitudes)
+        self.assertEqual(located.tolist(), ["a", "b", "b"])
+
+    def test_outside_grid(self):
+        space_index = SpaceIndex({1: square(0, 0, 1), 2: square(5, 5, 1)})
+        located = space_index.locate([-10, 100, 3, 0.5, 5.5], [-10, 100, 3, 0.5, 5.5])
+        self.assertEqual(located.tolist(), [None, None, None, 1, 2])
+        self.assertEqual(space_index.locate([], []).tolist(), [])
+
+    def test_horizontal_edges(self):
+        x = np.array([1, 2, 3.5, 3.5, 1, 5])
+        y = np.array([1, 1, 0.5, 1.5, 0, 1])
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            inside = contains(step, x, y)
+        self.assertEqual(inside.tolist(), [True, True, True, False, True, False])
+        located = SpaceIndex({"step": step}, cell_size=0.5).locate(x, y)
+        self.assertEqual(located.tolist(), ["step", "step", "step", None, "step", None])
+
+    def test_same_as_without_grid(self):
+        rng = np.random.default_rng(0)
+        polygons = {
+            i: square(*rng.uniform(0, 10, 2), rng.uniform(0.5, 3)) for i in range(20)
+        }
+        x, y = rng.uniform(-1, 12, 1000), rng.uniform(-1, 12, 1000)
+        expected = np.full(len(x), None, dtype=object)
+        for space_id, vertices in reversed(list(polygons.items())):
+            inside = contains(np.asarray(vertices, dtype=float), x, y)
+            expected[inside] = space_id
+        for cell_size in [None, 0.3, 20]:
+            located = SpaceIndex(polygons, cell_size).locate(x, y)
+            self.assertEqual(located.tolist(), expected.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
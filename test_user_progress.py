@@ -0,0 +1,206 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from studies import default_study
+from user_progress import UserProgress, compact_types, time_literal, vote_windows
+
+time_zone = "Asia/Singapore"
+spaces_dict = {-1: "outdoor", 1: "a", 2: "b"}
+
+
+def loop_counts(localised_user_df, min_time_between_votes, prev_time):
+    """
+    The vote classification before it was vectorized, one row at a time.
+    Returns the valid and invalid counts and prev_time
+    """
+    valid, invalid = 0, 0
+    delta_time = None
+    for vote_time, data in localised_user_df.iterrows():
+        # verify if the cozie datapoint has steerpath readings
+        if pd.isnull(data["Longitude"]) or pd.isnull(data["Latitude"]):
+            continue
+
+        # keep track of previous vote time
+        if prev_time is None:
+            prev_time = vote_time
+            delta_time = min_time_between_votes
+        else:
+            delta_time = abs((vote_time - prev_time).total_seconds() / 60)
+            if delta_time >= min_time_between_votes:
+                prev_time = vote_time
+
+        # two votes are extremly close in time and somehow both got registered to the database
+        if delta_time == 0:
+            continue
+
+        space = data["Space_id"] if not pd.isnull(data["Space_id"]) else -1
+        if space not in spaces_dict:
+            raise KeyError(space)
+
+        if delta_time >= min_time_between_votes:
+            valid += 1
+        else:
+            invalid += 1
+
+    return valid, invalid, prev_time
+
+
+def synthetic_votes(rng, n):
+    """Votes a few minutes apart, with duplicated timestamps and votes without location"""
+    minutes = np.sort(rng.integers(0, n * 20, n))
+    duplicates = rng.random(n) < 0.1
+    minutes[1:][duplicates[1:]] = minutes[:-1][duplicates[1:]]
+    index = pd.DatetimeIndex(
+        pd.Timestamp("2026-10-01", tz=time_zone) + pd.to_timedelta(minutes, unit="min")
+    ).unique()
+    n = len(index)
+    not_localised = rng.random(n) < 0.2
+    df = pd.DataFrame(
+        {
+            "thermal": rng.integers(9, 12, n),
+            "Longitude": np.where(not_localised, np.nan, rng.uniform(103.7, 103.8, n)),
+            "Latitude": np.where(not_localised, np.nan, rng.uniform(1.2, 1.3, n)),
+            "Space_id": rng.choice([1.0, 2.0, np.nan], n),
+        },
+        index=index,
+    )
+    return compact_types(df)
+
+
+class ClassifyVotesTest(unittest.TestCase):
+    def setUp(self):
+        study = default_study()
+        study.time_zone = time_zone
+        study.space_names = spaces_dict
+        study.space_polygons = {}
+        self.user_progress = UserProgress(80, 14, 14, influx_cl=object(), study=study)
+
+    def assert_same_as_loop(self, df, prev_time):
+        expected = loop_counts(df, self.user_progress.min_time_between_votes, prev_time)
+        valid, invalid, _, new_prev_time = self.user_progress.classify_votes(
+            "p", df, prev_time
+        )
+        self.assertEqual((valid.sum(), invalid.sum(), new_prev_time), expected)
+
+    def test_random_votes(self):
+        rng = np.random.default_rng(0)
+        for _ in range(100):
+            self.assert_same_as_loop(synthetic_votes(rng, rng.integers(0, 60)), None)
+
+    def test_continues_from_prev_time(self):
+        rng = np.random.default_rng(1)
+        for _ in range(100):
+            df = synthetic_votes(rng, rng.integers(1, 60))
+            # the last valid vote of the previous run, up to the first vote of this one
+            prev_time = df.index[0] - pd.Timedelta(minutes=int(rng.integers(0, 30)))
+            self.assert_same_as_loop(df, prev_time)
+
+    def test_missing_space(self):
+        df = synthetic_votes(np.random.default_rng(2), 10)
+        df["Space_id"] = 3.0
+        with self.assertRaises(KeyError):
+            self.user_progress.classify_votes("p", df, None)
+
+
+class LocateSpacesTest(unittest.TestCase):
+    def user_progress(self, space_names, space_polygons):
+        study = default_study()
+        study.time_zone = time_zone
+        study.space_names = space_names
+        study.space_polygons = space_polygons
+        return UserProgress(80, 14, 14, influx_cl=object(), study=study)
+
+    def localised_votes(self, space_ids):
+        index = pd.date_range("2026-10-01", periods=4, freq="h", tz=time_zone)
+        return pd.DataFrame(
+            {
+                "Longitude": [0.5, 0.5, 5.0, np.nan],
+                "Latitude": [0.5, 0.5, 5.0, np.nan],
+                "Space_id": space_ids,
+            },
+            index=index,
+        )
+
+    def test_string_ids(self):
+        user_progress = self.user_progress(
+            {"outdoor": "outdoor", "L1-a": "a", "L1-b": "b"},
+            {"L1-b": [(0, 0), (1, 0), (1, 1), (0, 1)]},
+        )
+        df = self.localised_votes(pd.Categorical(["L1-a", None, None, None]))
+        space_ids = user_progress.locate_spaces(df)
+        # only the missing ids of the votes in a space are filled
+        self.assertEqual(
+            space_ids.astype(object).where(space_ids.notnull(), None).tolist(),
+            ["L1-a", "L1-b", None, None],
+        )
+        self.assertIsInstance(space_ids.dtype, pd.CategoricalDtype)
+
+    def test_numeric_ids(self):
+        user_progress = self.user_progress(
+            spaces_dict, {2: [(0, 0), (1, 0), (1, 1), (0, 1)]}
+        )
+        df = self.localised_votes([1, np.nan, np.nan, np.nan])
+        space_ids = user_progress.locate_spaces(df)
+        self.assertEqual(space_ids.dtype, df["Space_id"].dtype)
+        np.testing.assert_array_equal(space_ids, [1, 2, np.nan, np.nan])
+
+
+class VoteWindowsTest(unittest.TestCase):
+    tol = 10 * 60 * 10**9  # ns
+
+    def vote_times(self, minutes):
+        return pd.DatetimeIndex(
+            pd.Timestamp("2026-10-01", tz=time_zone)
+            + pd.to_timedelta(np.asarray(minutes), unit="min")
+        )
+
+    def assert_covers(self, vote_times, windows):
+        """Every vote can be matched to the locations of its whole tolerance"""
+        starts, ends = np.array(windows).T
+        self.assertTrue((starts[1:] > ends[:-1]).all())
+        for vote_time in vote_times.values.astype("datetime64[ns]").astype("int64"):
+            i = np.searchsorted(starts, vote_time - self.tol, side="right") - 1
+            self.assertGreaterEqual(i, 0)
+            self.assertLessEqual(vote_time + self.tol, ends[i])
+
+    def test_overlapping_windows(self):
+        vote_times = self.vote_times([0, 5, 20, 100])
+        first, last = vote_times.values.astype("datetime64[ns]").astype("int64")[
+            [0, -1]
+        ]
+        windows = vote_windows(vote_times, self.tol, 50)
+        # the windows of the first three votes touch, they are merged
+        self.assertEqual(
+            windows,
+            [
+                (first - self.tol, first + 20 * 60 * 10**9 + self.tol),
+                (last - self.tol, last + self.tol),
+            ],
+        )
+        self.assert_covers(vote_times, windows)
+
+    def test_max_windows(self):
+        rng = np.random.default_rng(3)
+        vote_times = self.vote_times(rng.choice(10000, 60, replace=False))
+        n_windows = len(vote_windows(vote_times, self.tol, len(vote_times)))
+        self.assertGreater(n_windows, 10)
+        for max_windows in [1, 2, n_windows // 2, n_windows - 1]:
+            windows = vote_windows(vote_times, self.tol, max_windows)
+            self.assertEqual(len(windows), max_windows)
+            self.assert_covers(vote_times, windows)
+
+    def test_time_literal_round_trip(self):
+        rng = np.random.default_rng(4)
+        for ns in rng.integers(0, 2 * 10**18, 100).tolist() + [
+            0,
+            10**9,
+            10**9 - 1,
+        ]:
+            literal = time_literal(ns)
+            self.assertRegex(literal, r"^'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{9}Z'$")
+            self.assertEqual(pd.Timestamp(literal.strip("'")).value, ns)
+
+
+if __name__ == "__main__":
+    unittest.main()
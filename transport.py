@@ -0,0 +1,48 @@
+import asyncio
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+pool_maxsize = 32  # max number of keep-alive connections per host
+
+_session = None
+
+
+def get_session():
+    """
+    Session shared by every call to telegram and slack, the TCP+TLS connections
+    are kept alive and reused instead of opening a new one per request
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.mount("https://", HTTPAdapter(pool_maxsize=pool_maxsize))
+    return _session
+
+
+def close_session():
+    """Close the pooled connections, a new session is created if needed later"""
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+async def gather_bounded(calls, max_concurrency):
+    """
+    Run the blocking calls (functions without arguments) in threads with at most
+    max_concurrency of them at the same time. Returns the results in order,
+    exceptions are returned instead of raised
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return await asyncio.gather(
+            *(loop.run_in_executor(executor, call) for call in calls),
+            return_exceptions=True,
+        )
+
+
+def run_bounded(calls, max_concurrency):
+    """Same as gather_bounded, for code that is not running in an event loop"""
+    return asyncio.run(gather_bounded(calls, max_concurrency))
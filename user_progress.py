@@ -1,55 +1,280 @@
+import os
+import re
 import json
 import time
 import requests
+import numpy as np
 import pandas as pd
+import metrics
 import credentials as cd
-import space_names as sn 
 
-from copy import deepcopy
 from datetime import datetime, timedelta
+from studies import default_study
+from export import clear_export, export_votes
+from space_index import SpaceIndex
 from influxdb import InfluxDBClient, DataFrameClient
-from influxdb.exceptions import InfluxDBServerError
+from influxdb.exceptions import InfluxDBServerError, InfluxDBClientError
+
+def connect_influx(pool_size=10):
+    """
+    Client to the Influx database, it keeps up to pool_size connections alive
+    so it should be created once and shared by all the participants
+    """
+    return InfluxDBClient(host=cd.host, 
+                          port=cd.port, 
+                          username=cd.usr,
+                          password=cd.passwd,
+                          database=cd.database,
+                          ssl=True,
+                          verify_ssl=True,
+                          pool_size=pool_size)
+
 
 class UserProgress():
-    def __init__(self, min_votes=80, min_time_between_votes=15, loc_threshold_time_tol=10):
+    def __init__(self, min_votes=80, min_time_between_votes=15, loc_threshold_time_tol=10, influx_cl=None, study=None, cache=None):
         """
         Arguments for minimum time between votes and the time tolerance
-        for the location threshold are in minutes
+        for the location threshold are in minutes. influx_cl is a shared
+        client (see connect_influx), a new one is created if not given.
+        study holds the experiment settings (see studies.py), by default
+        the ones of credentials.py. The queries go through cache if given
+        (see InfluxCache)
         """
         # experiment specific
-        self.spaces_dict = sn.space_names
+        study = study if study is not None else default_study()
+        self.spaces_dict = study.space_names
+        # resolves the votes without Space_id, see classify_votes
+        self.space_index = SpaceIndex(study.space_polygons) if study.space_polygons else None
+        self.database = study.database
+        self.measurement = study.measurement
+        self.time_zone = study.time_zone
+        # opt-in export of the localised votes (see export.py)
+        self.export_location = study.path(export_dir) if study.export else None
         self.min_votes = min_votes
         self.min_time_between_votes = min_time_between_votes # min
         self.loc_threshold_time_tol = loc_threshold_time_tol # min 
 
         # connect to Influx
-        self.influx_cl = InfluxDBClient(host=cd.host, 
-                                        port=cd.port, 
-                                        username=cd.usr,
-                                        password=cd.passwd,
-                                        database=cd.database,
-                                        ssl=True,
-                                        verify_ssl=True)
+        self.influx_cl = influx_cl if influx_cl is not None else connect_influx()
+        self.cache = cache
         
+    def points_to_df(self, columns, values):
+        """
+        DataFrame of the points of a series, built from its columns instead of one
+        dict per point, with compact types (see compact_types) and the time as
+        index in the time zone of the study
+        """
+        df = pd.DataFrame(values, columns=columns)
+        # epochs and time strings are parsed with different resolutions, merge_asof needs the same
+        df.index = pd.DatetimeIndex(pd.to_datetime(df.pop('time'), utc=True).astype('datetime64[ns, UTC]')).tz_convert(self.time_zone)
+        return compact_types(df)
+
+    def query(self, query, **kwargs):
+        """Runs the query, unless its result is still in the cache"""
+        if self.cache is not None:
+            result = self.cache.get(query)
+            if result is not None:
+                metrics.count('influx_cache_hits')
+                return result
+        result = self.influx_cl.query(query, **kwargs)
+        if self.cache is not None:
+            self.cache.put(query, result)
+        return result
+
     def influx_to_df(self, query):
-        try:
-            result = self.influx_cl.query(query)
-            df = pd.DataFrame(result[result.keys()[0]])
-            df.index = pd.to_datetime(df.time)
-            df.index = df.index.tz_convert(cd.time_zone)
-            return df.drop(columns=['time'])
-        except IndexError:
-            return pd.DataFrame()
+        with metrics.timer('influx'):
+            try:
+                series = self.query(query).raw['series'][0]
+                return self.points_to_df(series['columns'], series['values'])
+            except (KeyError, IndexError):
+                return pd.DataFrame()
+
+    def influx_to_dfs(self, query, tag):
+        """
+        Runs a query grouped by tag and splits the result in one DataFrame per tag value
+        """
+        with metrics.timer('influx'):
+            dfs = {}
+            for series in self.query(query).raw.get('series', []):
+                if series.get('values'):
+                    dfs[series['tags'][tag]] = self.points_to_df(series['columns'], series['values'])
+            return dfs
+
+    @staticmethod
+    def participants_regex(participant_ids):
+        """InfluxQL regex matching exactly the given participant ids"""
+        ids = '|'.join(re.escape(str(p)).replace('/', '\\/') for p in participant_ids)
+        return f'/^({ids})$/'
 
     def last_vote(self, participant_id): 
-        query_vote = f'SELECT "thermal" FROM {cd.database}.autogen.{cd.measurement} WHERE userid=\'{participant_id}\' ORDER BY time Desc LIMIT 1'
+        query_vote = f'SELECT "thermal" FROM {self.database}.autogen.{self.measurement} WHERE userid=\'{participant_id}\' ORDER BY time Desc LIMIT 1'
         df_last_vote = self.influx_to_df(query_vote)
         # at least one datapoint should be available
         if df_last_vote.empty:
             return None, None, None
-        msg_timestamp = df_last_vote.index[0]
+        return self.time_since_vote(df_last_vote.index[0])
+
+    def last_votes(self, participant_ids):
+        """
+        Same as last_vote for a whole cohort with a single query.
+        With a cache, the participants checked less than cache.ttl seconds ago are
+        not queried again and the others only for the votes after their cached
+        last vote, votes are only appended. Participants without votes are
+        mapped to (None, None, None)
+        """
+        cached = self.cache.last_votes(participant_ids) if self.cache is not None else {}
+        now = time.time()
+        last_vote_times = {participant_id: last_vote_time for participant_id, (last_vote_time, checked_at) in cached.items()
+                           if now - checked_at < self.cache.ttl}
+        stale_ids = [participant_id for participant_id in participant_ids if participant_id not in last_vote_times]
+        if stale_ids:
+            new_ids = [participant_id for participant_id in stale_ids if cached.get(participant_id, (None, None))[0] is None]
+            tail_ids = [participant_id for participant_id in stale_ids if participant_id not in new_ids]
+            queried = self.query_last_votes(new_ids) if new_ids else {}
+            if tail_ids:
+                since = min(pd.Timestamp(cached[participant_id][0]) for participant_id in tail_ids)
+                queried.update(self.query_last_votes(tail_ids, since))
+            for participant_id in stale_ids:
+                last_vote_times[participant_id] = queried.get(participant_id, cached.get(participant_id, (None, None))[0])
+            if self.cache is not None:
+                self.cache.set_last_votes({participant_id: last_vote_times[participant_id] for participant_id in stale_ids})
+
+        return {participant_id: self.time_since_vote(pd.Timestamp(last_vote_times[participant_id]).tz_convert(self.time_zone))
+                                if last_vote_times[participant_id] is not None else (None, None, None)
+                for participant_id in participant_ids}
+
+    def query_last_votes(self, participant_ids, since=None):
+        """Time (ISO format) of the last vote after since of the participants that voted"""
+        query_votes = f'SELECT last("thermal") FROM {self.database}.autogen.{self.measurement} WHERE userid =~ {self.participants_regex(participant_ids)}{time_filter(since)} GROUP BY "userid"'
+        dfs_last_vote = self.influx_to_dfs(query_votes, 'userid')
+        return {participant_id: df.index[0].isoformat() for participant_id, df in dfs_last_vote.items()}
+
+    def cohort_history(self, participant_ids, since=None):
+        """
+        Queries the cozie responses of a whole cohort in one query, then their
+        locations (see location_history).
+        If since is given only the votes after it are queried (see daily_report).
+        Returns two dictionaries from participant id to DataFrame
+        """
+        regex = self.participants_regex(participant_ids)
+        query_cozie = f'SELECT "thermal" FROM {self.database}.autogen.{self.measurement} WHERE time < now() AND userid =~ {regex}{time_filter(since)} GROUP BY "userid"'
+        dfs_user = self.influx_to_dfs(query_cozie, 'userid')
+        return dfs_user, self.location_history(dfs_user)
+
+    def history_chunks(self, participant_id, since=None):
+        """
+        Streams the cozie responses of a participant after since, in chunks of
+        stream_chunk_size votes, each with the locations that can be matched to it
+        """
+        query_cozie = f'SELECT "thermal" FROM {self.database}.autogen.{self.measurement} WHERE time < now() AND userid=\'{participant_id}\'{time_filter(since)}'
+        for _, df_user in self.stream_points(query_cozie, stream_chunk_size):
+            yield df_user, self.location_history({participant_id: df_user}).get(participant_id, pd.DataFrame())
+
+    def stream_points(self, query, chunk_size):
+        """
+        Runs the query with a chunked response and yields the tags and the
+        DataFrame of each chunk as soon as it is read, instead of loading the
+        whole result. The times are read as epochs, without parsing strings
+        """
+        params = {'q': query, 'db': self.database, 'epoch': 'ns', 'chunked': 'true', 'chunk_size': chunk_size}
+        # the client asks for msgpack by default, the chunks are parsed as JSON lines
+        headers = dict(self.influx_cl._headers, Accept='application/json')
+        with metrics.timer('influx'):
+            response = self.influx_cl.request(url='query', method='GET', params=params, stream=True, expected_response_code=200, headers=headers)
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                for result in json.loads(line).get('results', []):
+                    if 'error' in result:
+                        raise InfluxDBClientError(result['error'])
+                    for series in result.get('series', []):
+                        if series.get('values'):
+                            metrics.count('influx_chunks')
+                            yield series.get('tags', {}), self.points_to_df(series['columns'], series['values'])
+        finally:
+            response.close()
+
+    def localise_votes(self, participant_id, df_user, df_loc):
+        """
+        Joins each cozie vote with the nearest location within loc_threshold_time_tol,
+        the locations are queried if df_loc is None
+        """
+        if df_loc is None:
+            df_loc = self.location_history({participant_id: df_user}).get(participant_id, pd.DataFrame())
+        if df_user.empty or df_loc.empty:
+            # none of the votes can be localised
+            return pd.DataFrame(columns=['thermal', 'Longitude', 'Latitude', 'Space_id'],
+                                index=pd.DatetimeIndex([], tz=self.time_zone))
+
+        # since the timestamp is the index, there cannot be more than one row with the same timestamp
+        with metrics.timer('merge_asof', participant_id):
+            localised_user_df = pd.merge_asof(df_user, df_loc, left_index=True, right_index=True, tolerance=pd.Timedelta(minutes=self.loc_threshold_time_tol), direction='nearest')
+        if self.space_index is not None:
+            localised_user_df['Space_id'] = self.locate_spaces(localised_user_df)
+        return localised_user_df
+
+    def locate_spaces(self, localised_user_df):
+        """
+        Space_id of the localised votes, the ones missing because of incomplete
+        geofencing are looked up from the coordinates in the polygons of the
+        spaces (see SpaceIndex), so they are exported and reported in their space.
+        The ids keep their type (e.g. strings) and the column its dtype
+        """
+        space_ids = localised_user_df['Space_id']
+        longitudes = localised_user_df['Longitude'].to_numpy(dtype=float)
+        latitudes = localised_user_df['Latitude'].to_numpy(dtype=float)
+        is_missing = space_ids.isnull().to_numpy() & ~np.isnan(longitudes) & ~np.isnan(latitudes)
+        if not is_missing.any():
+            return space_ids
 
-        last_msg_time = (pd.Timestamp.now(cd.time_zone) - msg_timestamp).total_seconds()/60 # min
+        located = self.space_index.locate(longitudes[is_missing], latitudes[is_missing])
+        is_located = pd.notnull(located)
+        metrics.count('located_votes', int(is_located.sum()))
+        positions = np.flatnonzero(is_missing)[is_located]
+        if isinstance(space_ids.dtype, pd.CategoricalDtype):
+            # spaces that none of the votes was geofenced in yet
+            new_ids = [space_id for space_id in pd.unique(located[is_located]) if space_id not in space_ids.cat.categories]
+            space_ids = space_ids.cat.add_categories(new_ids)
+            space_ids.iloc[positions] = located[is_located]
+            return space_ids
+        filled = space_ids.astype(object)
+        filled.iloc[positions] = located[is_located]
+        return filled.astype(space_ids.dtype)
+
+    def location_history(self, dfs_user):
+        """
+        Steerpath locations of the participants, only the columns used by the
+        report and only in the time windows where they can be matched to one of
+        their votes (see vote_windows). InfluxQL can't select several time ranges
+        in one statement, the statements of all the windows are sent in batches.
+        Returns a dictionary from participant id to DataFrame
+        """
+        tol = int(self.loc_threshold_time_tol * 60 * 10**9) # ns
+        statements = []
+        for participant_id, df_user in dfs_user.items():
+            for start, end in vote_windows(df_user.index, tol, max_location_windows):
+                statements.append((participant_id, f'SELECT "Longitude", "Latitude", "Space_id" FROM SteerPath.autogen.Steerpath WHERE Userid=\'{participant_id}\' AND time >= {time_literal(start)} AND time <= {time_literal(end)} AND time < now()'))
+        if not statements:
+            return {}
+
+        frames = {}
+        with metrics.timer('influx'):
+            for i in range(0, len(statements), statements_per_query):
+                batch = statements[i:i + statements_per_query]
+                results = self.query(';'.join(statement for _, statement in batch), method='POST')
+                # a single statement returns a ResultSet instead of a list
+                results = results if isinstance(results, list) else [results]
+                for (participant_id, _), result in zip(batch, results):
+                    for series in result.raw.get('series', []):
+                        if series.get('values'):
+                            frames.setdefault(participant_id, []).append(self.points_to_df(series['columns'], series['values']))
+            # the windows don't overlap and are in order
+            return {participant_id: compact_types(pd.concat(dfs)) if len(dfs) > 1 else dfs[0]
+                    for participant_id, dfs in frames.items()}
+
+    def time_since_vote(self, msg_timestamp):
+        last_msg_time = (pd.Timestamp.now(self.time_zone) - msg_timestamp).total_seconds()/60 # min
         
         if last_msg_time >= 2*24*60: # check if 2 days have passed
             last_msg_time = last_msg_time/(24*60) # convert from min to days
@@ -62,115 +287,219 @@ class UserProgress():
 
         return last_msg_time, time_unit, msg_timestamp
 
-    def daily_report(self, participant_id):
+    def classify_votes(self, participant_id, localised_user_df, prev_time):
+        """
+        Classifies the localised cozie votes as valid or invalid, continuing from
+        the time of the last valid vote (prev_time) of the votes processed before.
+        A vote is valid if at least min_time_between_votes passed since the last
+        valid vote, votes with the same timestamp as the last valid vote are
+        duplicates and are neither valid nor invalid.
+        Returns the valid and invalid masks over the rows of localised_user_df,
+        the space name of the counted votes and the updated prev_time.
+        Raises KeyError if a space_id is missing in the spaces file
+        """
+        # verify if the cozie datapoint has steerpath readings, otherwise the
+        # cozie vote was not given within range of a bluetooth beacon
+        is_localised = (localised_user_df['Longitude'].notnull() & localised_user_df['Latitude'].notnull()).to_numpy()
+        times = localised_user_df.index.values.astype('datetime64[ns]').astype('int64')[is_localised]
+        min_gap = int(self.min_time_between_votes * 60 * 10**9) # ns
+
+        # jump from valid vote to valid vote, the votes in between are too close to the previous one
+        is_valid = np.zeros(len(times), dtype=bool)
+        last_valid = prev_time.value if prev_time is not None else None
+        if last_valid is None and len(times) > 0:
+            # the very first vote is always valid
+            is_valid[0] = True
+            last_valid = times[0]
+        while last_valid is not None:
+            i = np.searchsorted(times, last_valid + min_gap, side='left')
+            if i == len(times):
+                break
+            is_valid[i] = True
+            last_valid = times[i]
+
+        # two votes are extremly close in time and somehow both got registered to the database
+        initial_prev = prev_time.value if prev_time is not None else np.iinfo(np.int64).min
+        last_valid_before = np.maximum.accumulate(np.where(is_valid, times, initial_prev))
+        is_duplicate = ~is_valid & (times == last_valid_before)
+        if is_duplicate.any():
+            metrics.count('duplicated_votes', int(is_duplicate.sum()), participant_id)
+
+        valid_mask = np.zeros(len(localised_user_df), dtype=bool)
+        valid_mask[is_localised] = is_valid
+        invalid_mask = np.zeros(len(localised_user_df), dtype=bool)
+        invalid_mask[is_localised] = ~is_valid & ~is_duplicate
+
+        # missing space_id is due to incomplete geofencing (see locate_spaces)
+        counted_space_ids = localised_user_df['Space_id'][valid_mask | invalid_mask].astype(object)
+        space_ids = counted_space_ids.where(counted_space_ids.notnull(), -1)
+        missing_spaces = [space for space in space_ids.unique() if space not in self.spaces_dict]
+        if missing_spaces:
+            raise KeyError(missing_spaces[0])
+        space_names = space_ids.map(self.spaces_dict)
+
+        if last_valid is not None:
+            prev_time = pd.Timestamp(int(last_valid), tz='UTC').tz_convert(self.time_zone)
+        return valid_mask, invalid_mask, space_names, prev_time
+
+    def daily_report(self, participant_id, df_user=None, df_loc=None, state=None):
         """
         Calculates a breakdown of valid, unvalid, and remaining data points
-        for a specific user
+        for a specific user. The cozie responses and locations are streamed in
+        chunks (see history_chunks) unless they were already fetched for the
+        cohort (see cohort_history), so the memory doesn't grow with the history.
+
+        If state is given (see load_report_state) only the votes after its
+        watermark are processed and the state is updated in place. Votes and
+        locations can reach the database late (Fitbit and phone sync), so the
+        votes of the last finalisation_lag hours are counted in the report but
+        only saved in the state by a later run, each run queries them again.
+        Data that arrives more than finalisation_lag hours late is only counted
+        by a rebuild. An empty state recomputes the report (and the export) from scratch
         """
+        if state is None:
+            state = {}
+        watermark = pd.Timestamp(state['watermark']) if 'watermark' in state else None
+        prev_time = pd.Timestamp(state['prev_time']).tz_convert(self.time_zone) if state.get('prev_time') else None
+        counts = {key: state.get(key, 0) for key in ('valid', 'invalid', 'total')}
+        # votes that can't change anymore are final, neither late data nor newer locations are expected for them
+        cutoff = pd.Timestamp.now(self.time_zone) - max(pd.Timedelta(hours=finalisation_lag), pd.Timedelta(minutes=self.loc_threshold_time_tol))
 
-        all_thermal = []
-        valid_points = []
-        invalid_points = []
-        points_within_sde = []
-        prev_time = None 
-        delta_time = None 
-        
-        # query cozie responses and locations for the same user, then merge them
-        query_cozie = f'SELECT "thermal" FROM {cd.database}.autogen.{cd.measurement} WHERE time < now() AND userid=\'{participant_id}\''
-        df_user = self.influx_to_df(query_cozie)
-        query_loc = f'SELECT * FROM SteerPath.autogen.Steerpath WHERE time < now() AND Userid=\'{participant_id}\' GROUP BY * ORDER BY time'
-        df_loc = self.influx_to_df(query_loc)
-        # since the timestamp is the index, there cannot be more than one row with the same timestamp
-        localised_user_df = pd.merge_asof(df_user, df_loc, left_index=True, right_index=True, tolerance=pd.Timedelta(minutes=self.loc_threshold_time_tol), direction='nearest')
-        
-        ### DEBUG
-        localised_user_df.to_csv(f'data/{participant_id}_merged.csv')
-        print(localised_user_df)
-        ###
+        chunks = self.history_chunks(participant_id, watermark) if df_user is None else [(df_user, df_loc)]
+        if watermark is None and self.export_location is not None:
+            # the whole history is exported again
+            clear_export(self.export_location, participant_id)
+        final_counts = dict(counts)
+        recent_dfs = []
+        try:
+            # the chunks are in time order, the classification continues from the previous chunk
+            for df_user, df_loc in chunks:
+                # the cohort data can start before the watermark of this participant
+                if watermark is not None and not df_user.empty:
+                    df_user = df_user[df_user.index > watermark]
+                localised_user_df = self.localise_votes(participant_id, df_user, df_loc)
 
-        # every vote so far for this user
-        for time, data in localised_user_df.iterrows():
-            try:
-                # verify if the cozie datapoint has steerpath readings 
-                if pd.isnull(data['Longitude']) or pd.isnull(data['Latitude']):
-                    # cozie vote was not given within range of a bluetooth beacon
-                    continue # ignore this datapoint
-
-                time_tz = time.astimezone(cd.time_zone)
-                # keep track of previous vote time
-                if prev_time == None: # only for the very first row
-                    prev_time = deepcopy(time_tz)
-                    delta_time = self.min_time_between_votes
-                else:
-                    # update time between votes 
-                    delta_time = abs((time_tz - prev_time).total_seconds()/60)
-                    if delta_time >= self.min_time_between_votes:
-                        prev_time = deepcopy(time_tz)
-                
-                # two votes are extremly close in time and somehow both got registered to the database
-                if delta_time == 0:
-                    print(f'Duplicated cozie vote for {participant_id} at {time}')
-                    continue # ignore this datapoint 
-
-                # missing space_id is due to incomplete geofencing
-                elif not pd.isnull(data['Space_id']):
-                    spaces = data['Space_id']
-                    longitudes = data['Longitude']
-                    latitudes = data['Latitude'] 
-                    loc_time = data.index
-                else:
-                    spaces = -1
-                    longitudes = data['Longitude']
-                    latitudes = data['Latitude'] 
-                    loc_time = data.index
-                
-                # keep track of the votes that are valid or invalid 
-                if delta_time >= self.min_time_between_votes:
-                    points_within_sde.append({"space_name":self.spaces_dict[spaces],
-                                             "longitude": longitudes,
-                                             "latitude": latitudes, 
-                                             "thermal":data["thermal"], 
-                                             "time": str(time_tz),
-                                             "type": "valid"
-                    })
-                    valid_points.append(delta_time)
-                else:
-                    points_within_sde.append({"space_name":self.spaces_dict[spaces],
-                                              "longitude": longitudes,
-                                              "latitude": latitudes, 
-                                              "thermal":data["thermal"], 
-                                              "time": str(time_tz),
-                                              "type": "invalid"
-                    })
-                    invalid_points.append(delta_time)
-
-            except Exception as e:
-                error_msg = f'Daily report error for participant {participant_id}:\n' 
-                error_msg += f'Space with space_id {e} not found in spaces file'
-                return error_msg, len(valid_points)
-
-            all_thermal.append(data['thermal'])
-            # end for loop
-
-        ### DEBUG
-        #print(valid_points)
-        #print(invalid_points)
-        ###
+                is_final = localised_user_df.index <= cutoff
+                if self.export_location is not None:
+                    with metrics.timer('export', participant_id):
+                        export_votes(self.export_location, participant_id, localised_user_df[is_final])
+                with metrics.timer('classify', participant_id):
+                    final_valid, final_invalid, _, prev_time = self.classify_votes(participant_id, localised_user_df[is_final], prev_time)
+                final_counts = {'valid': final_counts['valid'] + int(final_valid.sum()),
+                                'invalid': final_counts['invalid'] + int(final_invalid.sum()),
+                                'total': final_counts['total'] + int(final_valid.sum() + final_invalid.sum())}
+                recent_dfs.append(localised_user_df[~is_final])
+
+            recent_df = pd.concat(recent_dfs) if recent_dfs else self.localise_votes(participant_id, pd.DataFrame(), pd.DataFrame())
+            with metrics.timer('classify', participant_id):
+                valid, invalid, _, _ = self.classify_votes(participant_id, recent_df, prev_time)
+        except KeyError as e:
+            error_msg = f'Daily report error for participant {participant_id}:\n' 
+            error_msg += f'Space with space_id {e} not found in spaces file'
+            return error_msg, counts['valid']
+
+        counts = {'valid': final_counts['valid'] + int(valid.sum()),
+                  'invalid': final_counts['invalid'] + int(invalid.sum()),
+                  'total': final_counts['total'] + int(valid.sum() + invalid.sum())}
+        state.update(final_counts)
+        state['watermark'] = str(cutoff)
+        state['prev_time'] = str(prev_time) if prev_time is not None else None
 
         # format daily report message
-        last_input = data
-        msg = f'Hi {participant_id}, as of {pd.Timestamp.now(cd.time_zone).strftime("%b-%d %H:%M")}:\n'
-        if len(valid_points) >= self.min_votes:
+        msg = f'Hi {participant_id}, as of {pd.Timestamp.now(self.time_zone).strftime("%b-%d %H:%M")}:\n'
+        if counts['valid'] >= self.min_votes:
             msg += 'Congratulations! You completed at least 80 data points inside SDE buildings\n'
             # TODO: breakdown of current points
            
-        if len(points_within_sde) > 0:
-            msg += f'Total data points: {len(all_thermal)}\n'
-            msg += f'Valid data points (within SDE): {len(valid_points)} out of {self.min_votes}\n'
-            msg += f'Data points left: {80-len(valid_points) if len(valid_points) <= 80 else 0}\n'
+        if counts['valid'] + counts['invalid'] > 0:
+            msg += f'Total data points: {counts["total"]}\n'
+            msg += f'Valid data points (within SDE): {counts["valid"]} out of {self.min_votes}\n'
+            msg += f'Data points left: {80-counts["valid"] if counts["valid"] <= 80 else 0}\n'
         else:
             msg += 'You haven\'t recorded any valid data points yet\n'
             msg += 'Don\'t forget to turn on the YAK application and bluetooth before leaving feedback on the Fitbit smartwatch \n'
             
-        return msg, len(valid_points)
+        return msg, counts['valid']
+
+
+export_dir = 'export'  # in the directory of the study
+categorical_columns = ['Space_id']  # see compact_types
+coordinate_columns = ['Longitude', 'Latitude']  # kept in float64, float32 rounds them to about 1 m
+max_location_windows = 50  # per participant and run, see vote_windows
+statements_per_query = 100  # location windows queried in one request
+finalisation_lag = 24  # hours of late data expected, see daily_report
+stream_chunk_size = 1000  # votes per chunk of a streamed history, see daily_report
+
+
+def compact_types(df):
+    """
+    Downcast the numeric columns and store the categorical ones as categories,
+    the frames of long histories take a fraction of the memory. The coordinates
+    keep their precision for the export and the space polygons
+    """
+    for column in df.columns:
+        if column in categorical_columns:
+            df[column] = df[column].astype('category')
+        elif column in coordinate_columns:
+            df[column] = df[column].astype('float64')
+        elif pd.api.types.is_float_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast='float')
+        elif pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+    return df
+
+
+def vote_windows(vote_times, tol, max_windows):
+    """
+    Time windows (ns) of tol around the votes, where a location can be matched
+    to them (see the tolerance of merge_asof in daily_report). Overlapping
+    windows are merged, if there are more than max_windows the closest ones are
+    merged too and the windows also cover the time between them
+    """
+    times = np.sort(vote_times.values.astype('datetime64[ns]').astype('int64'))
+    if len(times) == 0:
+        return []
+    # a vote starts a new window if it can't share any location with the previous one
+    is_first = np.ones(len(times), dtype=bool)
+    is_first[1:] = times[1:] - tol > times[:-1] + tol
+    is_last = np.append(is_first[1:], True)
+    starts, ends = times[is_first] - tol, times[is_last] + tol
+
+    if len(starts) > max_windows:
+        # keep the largest gaps between the windows
+        gaps = starts[1:] - ends[:-1]
+        kept_gaps = np.sort(np.argsort(gaps, kind='stable')[len(gaps) - (max_windows - 1):])
+        starts = np.append(starts[0], starts[kept_gaps + 1])
+        ends = np.append(ends[kept_gaps], ends[-1])
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def time_literal(ns):
+    """RFC3339 InfluxQL time literal of a timestamp in ns, keeping the nanoseconds"""
+    return f"'{pd.Timestamp(ns, tz='UTC').strftime('%Y-%m-%dT%H:%M:%S')}.{ns % 10**9:09d}Z'"
+
+
+def time_filter(since):
+    """InfluxQL condition selecting the points after since, empty if since is None"""
+    if since is None:
+        return ''
+    return f" AND time > '{pd.Timestamp(since).tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%S.%fZ')}'"
+
+
+def load_report_state(location):
+    """
+    Per-participant state of the incremental daily report: watermark of the
+    processed votes, time of the last valid vote and valid/invalid/total counters
+    """
+    try:
+        return json.load(open(location))
+    except FileNotFoundError:
+        return {}
+
 
+def save_report_state(report_state, location):
+    """Write the report state atomically, a crash mid-dump keeps the previous state"""
+    tmp_location = f'{location}.tmp'
+    with open(tmp_location, 'w') as f:
+        json.dump(report_state, f)
+    os.replace(tmp_location, location)